@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# coding=utf-8
+import os
+import sys
+import time
+import random
+import tarfile
+
+from utils import escape_ntfs_invalid, member_path
+
+# measures escape_ntfs_invalid() over a listing of a root filesystem, against the chained
+# str.replace() calls it used to be. the listing is taken from the member names of a tarball,
+# from a walk of a directory, or is generated to look like the tree of a Debian installation,
+# where around 2% of the paths are Perl man pages with '::' in their names.
+
+source = None
+count  = 100000
+runs   = 7
+
+for arg in sys.argv[1:]:
+	if arg.lower().startswith('--paths='):
+		try:
+			count = max(1, int(arg[len('--paths='):]))
+		except ValueError:
+			count = None
+			break
+	elif arg.lower().startswith('--runs='):
+		try:
+			runs = max(1, int(arg[len('--runs='):]))
+		except ValueError:
+			count = None
+			break
+	elif arg.startswith('--') or source is not None:
+		count = None
+		break
+	else:
+		source = arg
+
+if count is None:
+	print('usage: ./bench-escape.py [--paths=N] [--runs=N] [tarball | directory]')
+	sys.exit(-1)
+
+
+def escape_replace(name):
+	"""
+	Escapes characters which are forbidden in NTFS the way escape_ntfs_invalid() used to.
+
+	:param name: Path potentially containing forbidden NTFS characters.
+
+	:return: Path with forbidden NTFS characters escaped.
+	"""
+
+	return name.replace('*', '#002A').replace('|', '#007C').replace(':', '#003A').replace('>', '#003E').replace('<', '#003C').replace('?', '#003F').replace('"', '#0022')
+
+
+def generate_paths(count):
+	"""
+	Generates the paths of a made up Debian installation, always the same for the same count.
+
+	:param count: Number of paths.
+
+	:return: List of the paths.
+	"""
+
+	rand  = random.Random(0)
+	words = ['lib', 'core', 'util', 'python3', 'perl', 'gtk', 'x11', 'ssl', 'dbus', 'systemd', 'glib', 'apt', 'gnu', 'base', 'common', 'data', 'tools', 'dev', 'bin', 'extra']
+	langs = ['de', 'fr', 'es', 'it', 'ja', 'pt_BR', 'ru', 'zh_CN', 'sv', 'nl', 'pl', 'cs']
+	paths = []
+
+	def word():
+		return '-'.join(rand.choice(words) for i in range(rand.randint(1, 3)))
+
+	while len(paths) < count:
+		kind = rand.random()
+
+		if kind < 0.02:
+			module = '::'.join(word().replace('-', '').capitalize() for i in range(rand.randint(2, 4)))
+			paths.append('usr/share/man/man3/%s.3pm.gz' % module)
+		elif kind < 0.30:
+			paths.append('usr/share/doc/%s/%s' % (word(), rand.choice(['copyright', 'changelog.Debian.gz', 'NEWS.gz', 'README', 'examples/%s.conf' % word()])))
+		elif kind < 0.45:
+			paths.append('usr/lib/x86_64-linux-gnu/lib%s.so.%d' % (word(), rand.randint(0, 9)))
+		elif kind < 0.60:
+			paths.append('usr/share/locale/%s/LC_MESSAGES/%s.mo' % (rand.choice(langs), word()))
+		elif kind < 0.75:
+			paths.append('usr/lib/python3/dist-packages/%s/%s.py' % (word().replace('-', '_'), word().replace('-', '_')))
+		elif kind < 0.85:
+			paths.append('usr/share/man/man%d/%s.%d.gz' % (rand.randint(1, 8), word(), rand.randint(1, 8)))
+		elif kind < 0.95:
+			paths.append('usr/%s/%s' % (rand.choice(['bin', 'sbin', 'include', 'share/perl5']), word()))
+		else:
+			paths.append('%s/%s' % (rand.choice(['etc', 'var/lib/dpkg/info', 'lib/systemd/system']), word()))
+
+	return paths
+
+
+def read_paths(source):
+	"""
+	Collects the paths of the entries of a tarball or a directory.
+
+	:param source: Path to the tarball or the directory.
+
+	:return: List of the paths, relative to the root of the tree.
+	"""
+
+	paths = []
+
+	if os.path.isdir(source):
+		for root, dirs, files in os.walk(source):
+			for name in dirs + files:
+				paths.append(os.path.relpath(os.path.join(root, name), source).replace(os.sep, '/'))
+
+	else:
+		with tarfile.open(source, 'r:*') as tar:
+			for member in tar:
+				paths.append(member_path(member.name))
+
+	return paths
+
+
+def measure(func, paths):
+	"""
+	Runs a function over all the paths multiple times, and measures the fastest run.
+
+	:param func: Function to run on each path.
+	:param paths: List of the paths.
+
+	:return: Time of the fastest run in seconds.
+	"""
+
+	best = None
+
+	for i in range(runs):
+		start = time.perf_counter()
+
+		for path in paths:
+			func(path)
+
+		elapsed = time.perf_counter() - start
+		best    = elapsed if best is None else min(best, elapsed)
+
+	return best
+
+
+if source is not None:
+	paths = read_paths(source)
+
+	if not paths:
+		print('No paths found in %s.' % source)
+		sys.exit(-1)
+
+	# repeat the listing of small trees until there are enough paths
+
+	paths = (paths * (count // len(paths) + 1))[:count]
+
+else:
+	paths = generate_paths(count)
+
+escaped = sum(1 for path in paths if escape_ntfs_invalid(path) != path)
+
+for path in paths:
+	if escape_ntfs_invalid(path) != escape_replace(path):
+		print('Mismatch for %s: %s != %s' % (path, escape_ntfs_invalid(path), escape_replace(path)))
+		sys.exit(-1)
+
+root    = 'C:/Users/user/AppData/Local/lxss/rootfs'
+benches = [
+	('str.replace chain', escape_replace),
+	('escape_ntfs_invalid', escape_ntfs_invalid),
+	('root + / + escaped', lambda path: root + '/' + escape_ntfs_invalid(path)),
+]
+
+print('%d paths, %d of them with characters to escape, fastest of %d runs:' % (len(paths), escaped, runs))
+
+for name, func in benches:
+	best = measure(func, paths)
+	print('%-22s %7.1f ms %7.0f ns/path' % (name, best * 1000, best / len(paths) * 1e9))
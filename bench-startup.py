@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# coding=utf-8
+import os
+import ast
+import sys
+import time
+import statistics
+import subprocess
+
+# measures the startup time of the scripts, which is mostly spent importing modules. the scripts
+# run as soon as they are loaded, so instead of starting them, the imports at their top level are
+# extracted and run in a fresh interpreter, and the time of an empty interpreter is subtracted.
+
+scripts  = ['switch.py', 'install.py', 'export.py', 'get-source.py', 'get-prebuilt.py']
+selected = []
+runs     = 20
+
+for arg in sys.argv[1:]:
+	if arg.lower().startswith('--runs='):
+		try:
+			runs = max(1, int(arg[len('--runs='):]))
+		except ValueError:
+			selected = None
+			break
+	elif arg.startswith('--'):
+		selected = None
+		break
+	else:
+		selected.append(arg)
+
+if selected is None:
+	print('usage: ./bench-startup.py [--runs=N] [script.py ...]')
+	sys.exit(-1)
+
+if selected:
+	scripts = selected
+
+basedir = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_imports(script):
+	"""
+	Collects the import statements at the top level of a script, including the ones
+	guarded by try blocks for optional dependencies.
+
+	:param script: Path to the script.
+
+	:return: Source code of the import statements.
+	"""
+
+	with open(script) as f:
+		tree = ast.parse(f.read(), script)
+
+	nodes = []
+
+	for node in tree.body:
+		if isinstance(node, (ast.Import, ast.ImportFrom)):
+			nodes.append(node)
+
+		elif isinstance(node, ast.Try) and all(isinstance(stmt, (ast.Import, ast.ImportFrom, ast.Assign)) for stmt in node.body):
+			nodes.append(node)
+
+	return ast.unparse(ast.Module(body = nodes, type_ignores = []))
+
+
+def measure(code):
+	"""
+	Runs code in fresh interpreters and measures the time until they exit.
+
+	:param code: Source code to run.
+
+	:return: List of the times in seconds.
+	"""
+
+	times = []
+
+	# the first run warms up the file system cache and writes the bytecode cache
+
+	for i in range(runs + 1):
+		start = time.perf_counter()
+		subprocess.run([sys.executable, '-c', code], cwd = basedir, check = True)
+
+		if i > 0:
+			times.append(time.perf_counter() - start)
+
+	return times
+
+
+base = statistics.median(measure('pass'))
+
+print('%-16s %10s %10s   (median and minimum of %d runs, minus %.1f ms for the interpreter)' % ('script', 'median', 'min', runs, base * 1000))
+
+for script in scripts:
+	times = measure(get_imports(os.path.join(basedir, script)))
+	print('%-16s %7.1f ms %7.1f ms' % (script, (statistics.median(times) - base) * 1000, (min(times) - base) * 1000))
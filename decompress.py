@@ -0,0 +1,622 @@
+#!/usr/bin/env python3
+# coding=utf-8
+import io
+import lzma
+import mmap
+import zlib
+import struct
+import collections
+import concurrent.futures
+
+from utils import ProgressReporter
+
+
+# the tarfile module decompresses archives on a single core. however, the gzip archives assembled
+# by get-prebuilt.py are a concatenation of independent gzip members (one per layer) and the xz
+# archives produced by multi-threaded xz are made up of independently compressed blocks. these
+# can be decompressed in parallel, then stitched back together in order.
+#
+# zlib and lzma release the GIL while decompressing, so a thread pool keeps multiple cores busy
+# without the need for worker processes, which would otherwise re-run the calling script on
+# Windows due to the lack of fork(), and would have to pickle every decompressed chunk back.
+
+GZIP_MAGIC = b'\x1f\x8b\x08'
+XZ_MAGIC   = b'\xfd7zXZ\x00'
+
+# size of the slices fed to the decompressors
+
+SLICE_SIZE = 4 * 1024 * 1024
+
+
+def _inflate_member(view, start, limit):
+	"""
+	Decompresses a single gzip member, unless it turns out to be larger than expected.
+
+	:param view: Memory view of the whole archive.
+	:param start: Offset of the gzip member.
+	:param limit: Maximum size of the decompressed contents.
+
+	:return: Offset of the end of the member and its decompressed contents, or None if the limit was exceeded.
+	"""
+
+	d    = zlib.decompressobj(31)
+	pos  = start
+	out  = []
+	size = 0
+
+	while not d.eof:
+		if d.unconsumed_tail:
+			chunk = d.unconsumed_tail
+
+		elif pos >= len(view):
+			raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+		else:
+			chunk = view[pos:pos + SLICE_SIZE]
+			pos  += len(chunk)
+
+		# ask for one byte more than allowed, in order to tell a member of exactly the limit from a larger one
+
+		data  = d.decompress(chunk, limit - size + 1)
+		size += len(data)
+
+		if size > limit:
+			return None
+
+		out.append(data)
+
+	return pos - len(d.unused_data), b''.join(out)
+
+
+def _varint(buf, pos):
+	"""
+	Decodes a variable-length integer used by the xz format.
+
+	:param buf: Buffer to decode from.
+	:param pos: Offset of the integer.
+
+	:return: Decoded value and offset after the integer.
+	"""
+
+	value = 0
+	shift = 0
+
+	while True:
+		byte = buf[pos]
+		pos += 1
+		value |= (byte & 0x7F) << shift
+		shift += 7
+
+		if byte & 0x80 == 0:
+			return value, pos
+
+
+def _mkvarint(value):
+	"""
+	Encodes a variable-length integer used by the xz format.
+
+	:param value: Value to encode.
+
+	:return: Encoded bytes.
+	"""
+
+	out = bytearray()
+
+	while value >= 0x80:
+		out.append((value & 0x7F) | 0x80)
+		value >>= 7
+
+	out.append(value)
+	return bytes(out)
+
+
+def _xz_blocks(view):
+	"""
+	Parses the indexes of an xz file in order to locate its blocks.
+
+	:param view: Memory view of the whole archive.
+
+	:return: List of (offset, unpadded size, uncompressed size, stream flags) tuples.
+	"""
+
+	blocks = []
+	end    = len(view)
+
+	while end > 0:
+
+		# skip stream padding
+
+		while end >= 4 and view[end - 4:end] == b'\0\0\0\0':
+			end -= 4
+
+		if end == 0:
+			break
+
+		if end < 24 or view[end - 2:end] != b'YZ':
+			raise ValueError('invalid xz stream footer')
+
+		backward, = struct.unpack_from('<I', view, end - 8)
+		flags     = bytes(view[end - 4:end - 2])
+		isize     = (backward + 1) * 4
+		istart    = end - 12 - isize
+
+		if istart < 12 or view[istart] != 0:
+			raise ValueError('invalid xz index')
+
+		count, pos = _varint(view, istart + 1)
+		records    = []
+
+		for i in range(count):
+			unpadded, pos     = _varint(view, pos)
+			uncompressed, pos = _varint(view, pos)
+			records.append((unpadded, uncompressed))
+
+		sstart = istart - sum((unpadded + 3) & ~3 for unpadded, _ in records) - 12
+
+		if sstart < 0 or view[sstart:sstart + 6] != XZ_MAGIC:
+			raise ValueError('invalid xz stream header')
+
+		offset = sstart + 12
+		stream = []
+
+		for unpadded, uncompressed in records:
+			stream.append((offset, unpadded, uncompressed, flags))
+			offset += (unpadded + 3) & ~3
+
+		blocks[:0] = stream
+		end = sstart
+
+	return blocks
+
+
+def _xz_wrap(unpadded, uncompressed, flags):
+	"""
+	Generates the header and the trailer of a standalone xz stream containing a single block.
+
+	:param unpadded: Unpadded size of the block.
+	:param uncompressed: Uncompressed size of the block.
+	:param flags: Stream flags of the original stream.
+
+	:return: Stream header and stream trailer (index and footer).
+	"""
+
+	header = XZ_MAGIC + flags + struct.pack('<I', zlib.crc32(flags))
+
+	index  = b'\0' + _mkvarint(1) + _mkvarint(unpadded) + _mkvarint(uncompressed)
+	index += b'\0' * (-len(index) % 4)
+	index += struct.pack('<I', zlib.crc32(index))
+
+	backward = struct.pack('<I', len(index) // 4 - 1)
+	footer   = struct.pack('<I', zlib.crc32(backward + flags)) + backward + flags + b'YZ'
+
+	return header, index + footer
+
+
+def _unxz_block(view, block):
+	"""
+	Decompresses a single xz block by wrapping it into a standalone stream.
+
+	:param view: Memory view of the whole archive.
+	:param block: Block information from _xz_blocks().
+
+	:return: Decompressed contents of the block.
+	"""
+
+	offset, unpadded, uncompressed, flags = block
+	header, trailer = _xz_wrap(unpadded, uncompressed, flags)
+
+	d   = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+	out = [d.decompress(header)]
+
+	out.append(d.decompress(view[offset:offset + ((unpadded + 3) & ~3)]))
+	out.append(d.decompress(trailer))
+
+	if not d.eof:
+		raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+	return b''.join(out)
+
+
+# file object decompressing gzip and xz archives on multiple threads, with progress bar
+
+class ParallelReader(io.RawIOBase):
+	"""
+	Read-only, non-seekable file object returning the decompressed contents of a multi-member
+	gzip or multi-block xz archive. Members and blocks are decompressed ahead of the reader on
+	a thread pool, while the amount of decompressed data held in memory is kept under budget.
+	Members and blocks larger than the budget are decompressed incrementally on the reading
+	thread instead.
+	"""
+
+	def __init__(self, path, workers, budget = 256 * 1024 * 1024):
+		io.RawIOBase.__init__(self)
+
+		self.file    = open(path, 'rb')
+		self.map     = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+		self.view    = memoryview(self.map)
+		self.size    = len(self.map)
+		self.budget  = budget
+		self.workers = max(1, workers)
+		self.pool    = concurrent.futures.ThreadPoolExecutor(self.workers)
+		self.buffer  = memoryview(b'')
+		self.offset  = 0
+		self.chunks  = None
+
+		if self.view[:len(XZ_MAGIC)] == XZ_MAGIC:
+			self.blocks = _xz_blocks(self.view)
+			self.chunks = self._xz_chunks()
+		else:
+			self.blocks = self._gzip_members()
+			self.chunks = self._gzip_chunks()
+
+		self.progress = ProgressReporter(sample = lambda: (self.offset, self.size)).start()
+
+	@staticmethod
+	def is_parallel(path):
+		"""
+		Determines whether the archive is made up of multiple gzip members or xz blocks,
+		and as such, whether decompressing it in parallel is of any use.
+
+		:param path: Path to the archive.
+
+		:return: Evaluation result.
+		"""
+
+		try:
+			with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as m:
+				view = memoryview(m)
+
+				try:
+					if view[:len(XZ_MAGIC)] == XZ_MAGIC:
+						return len(_xz_blocks(view)) > 1
+
+					elif view[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+						return m.find(GZIP_MAGIC, 1) != -1
+
+					return False
+
+				finally:
+					view.release()
+
+		except (OSError, ValueError, IndexError, struct.error):
+			return False
+
+	def _gzip_members(self):
+		"""
+		Finds the offsets of all potential gzip member headers. The list may contain false
+		positives from within compressed data; those are sorted out while stitching.
+		"""
+
+		offsets = []
+		pos     = self.map.find(GZIP_MAGIC, 0)
+
+		while pos != -1:
+
+			# reserved bits of the flags must be zero and the OS identifier must be a known one
+
+			if pos + 9 < self.size and self.map[pos + 3] & 0xE0 == 0 and (self.map[pos + 9] <= 13 or self.map[pos + 9] == 255):
+				offsets.append(pos)
+
+			pos = self.map.find(GZIP_MAGIC, pos + 1)
+
+		return offsets
+
+	def _gzip_estimate(self, idx):
+
+		# ISIZE in the trailer of the member, assuming the next candidate is the next member. the
+		# candidate may be a false positive within the compressed data, and ISIZE is only the size
+		# modulo 2^32, so the estimate may be too small, which _inflate_member() catches
+
+		end = self.blocks[idx + 1] if idx + 1 < len(self.blocks) else self.size
+
+		try:
+			return struct.unpack_from('<I', self.view, end - 4)[0]
+		except struct.error:
+			return self.budget
+
+	def _gzip_stream(self, start):
+
+		# incremental decompression of a member too large to be held in memory
+
+		d   = zlib.decompressobj(31)
+		pos = start
+
+		while not d.eof:
+			if pos >= self.size:
+				raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+			chunk = self.view[pos:pos + SLICE_SIZE]
+			pos  += len(chunk)
+			data  = d.decompress(chunk)
+
+			if not d.eof:
+				self.offset = pos
+				yield data
+
+		self.offset = pos - len(d.unused_data)
+		yield data
+
+	def _gzip_chunks(self):
+		futures  = collections.OrderedDict()
+		inflight = 0
+		nextidx  = 0
+		pos      = 0
+
+		try:
+			while pos < self.size:
+
+				# gzip allows zero padding after the last member
+
+				if self.map[pos] == 0:
+					pos += 1
+					continue
+
+				# drop speculative jobs which turned out to be within the previous member
+
+				for start in [start for start in futures if start < pos]:
+					future, estimate = futures.pop(start)
+					future.cancel()
+					inflight -= estimate
+
+				while nextidx < len(self.blocks) and self.blocks[nextidx] < pos:
+					nextidx += 1
+
+				# schedule the member at the current position and the ones following it
+
+				while nextidx < len(self.blocks) and len(futures) < self.workers * 2:
+					estimate = min(self._gzip_estimate(nextidx), self.budget)
+
+					if len(futures) > 0 and inflight + estimate > self.budget:
+						break
+
+					if estimate >= self.budget and self.blocks[nextidx] != pos:
+						break
+
+					start = self.blocks[nextidx]
+					futures[start] = (self.pool.submit(_inflate_member, self.view, start, estimate), estimate) if estimate < self.budget else (None, estimate)
+					inflight += estimate
+					nextidx  += 1
+
+				if pos not in futures:
+					raise ValueError('Not a gzipped file at offset %d' % pos)
+
+				future, estimate = futures.pop(pos)
+				inflight -= estimate
+
+				if future is None:
+					yield from self._gzip_stream(pos)
+					pos = self.offset
+					continue
+
+				result = future.result()
+
+				# the member was larger than estimated, and is decompressed incrementally instead
+
+				if result is None:
+					yield from self._gzip_stream(pos)
+					pos = self.offset
+					continue
+
+				pos, data   = result
+				self.offset = pos
+				yield data
+
+		finally:
+
+			# the reader may be closed before the end, the jobs which did not start yet are not needed anymore
+
+			for future, estimate in futures.values():
+				if future is not None:
+					future.cancel()
+
+	def _xz_chunks(self):
+		futures  = collections.deque()
+		inflight = 0
+		nextidx  = 0
+
+		try:
+			while nextidx < len(self.blocks) or len(futures) > 0:
+
+				# schedule the blocks following the one being read
+
+				while nextidx < len(self.blocks) and len(futures) < self.workers * 2:
+					block    = self.blocks[nextidx]
+					estimate = min(block[2], self.budget)
+
+					if len(futures) > 0 and inflight + estimate > self.budget:
+						break
+
+					futures.append((self.pool.submit(_unxz_block, self.view, block) if estimate < self.budget else None, estimate, block))
+					inflight += estimate
+					nextidx  += 1
+
+				future, estimate, block = futures.popleft()
+				inflight -= estimate
+
+				if future is None:
+
+					# incremental decompression of a block too large to be held in memory
+
+					header, trailer = _xz_wrap(block[1], block[2], block[3])
+					d = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+					d.decompress(header)
+
+					end = block[0] + ((block[1] + 3) & ~3)
+
+					for pos in range(block[0], end, SLICE_SIZE):
+						self.offset = pos
+						yield d.decompress(self.view[pos:min(end, pos + SLICE_SIZE)])
+
+					self.offset = end
+					yield d.decompress(trailer)
+
+				else:
+					self.offset = block[0] + block[1]
+					yield future.result()
+
+		finally:
+			for future, estimate, block in futures:
+				if future is not None:
+					future.cancel()
+
+	def readable(self):
+		return True
+
+	def readinto(self, b):
+		"""
+		Read bytes into a pre-allocated, writable bytes-like object b.
+		Returns 0 at EOF.
+		"""
+
+		while len(self.buffer) == 0:
+			chunk = next(self.chunks, None)
+
+			if chunk is None:
+				return 0
+
+			self.buffer = memoryview(chunk)
+
+		size = min(len(b), len(self.buffer))
+		b[:size] = self.buffer[:size]
+		self.buffer = self.buffer[size:]
+
+		return size
+
+	def close(self):
+		if self.closed:
+			return
+
+		self.progress.stop()
+
+		if self.chunks is not None:
+			self.chunks.close()
+
+		self.pool.shutdown(wait = True)
+		self.buffer.release()
+		self.view.release()
+		self.map.close()
+		self.file.close()
+
+		io.RawIOBase.close(self)
+
+
+# the same applies the other way around when exporting a rootfs: the tarball is cut into chunks,
+# which are compressed on a thread pool into independent gzip members or xz streams, then written
+# out in order. the result is a valid archive for any tool, and ParallelReader can decompress it
+# on multiple threads again, at the expense of a slightly worse compression ratio.
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def _deflate_member(data, level):
+	"""
+	Compresses a chunk into a standalone gzip member.
+
+	:param data: Chunk to compress.
+	:param level: Compression level.
+
+	:return: Compressed gzip member.
+	"""
+
+	c = zlib.compressobj(level, zlib.DEFLATED, 31)
+	return c.compress(data) + c.flush()
+
+
+def _xz_stream(data, level):
+	"""
+	Compresses a chunk into a standalone xz stream.
+
+	:param data: Chunk to compress.
+	:param level: Compression preset.
+
+	:return: Compressed xz stream.
+	"""
+
+	return lzma.compress(data, lzma.FORMAT_XZ, preset = level)
+
+
+# file object compressing into gzip and xz archives on multiple threads
+
+class ParallelWriter(io.RawIOBase):
+	"""
+	Write-only, non-seekable file object compressing the data written to it into a multi-member
+	gzip or multi-stream xz archive. The chunks are compressed on a thread pool, and at most two
+	chunks per worker are held in memory, after which writing blocks until the oldest one is done.
+	"""
+
+	compressors = {'gz': (_deflate_member, 6), 'xz': (_xz_stream, 6)}
+
+	def __init__(self, path, workers, compression = 'gz', level = None, chunk = CHUNK_SIZE):
+		io.RawIOBase.__init__(self)
+
+		self.compress, default = ParallelWriter.compressors[compression]
+
+		self.file     = open(path, 'wb')
+		self.level    = default if level is None else level
+		self.chunk    = chunk
+		self.workers  = max(1, workers)
+		self.pool     = concurrent.futures.ThreadPoolExecutor(self.workers)
+		self.pending  = collections.deque()
+		self.buffer   = bytearray()
+		self.position = 0
+		self.written  = 0
+
+	def _submit(self, data):
+		while len(self.pending) >= self.workers * 2:
+			self._drain()
+
+		self.pending.append(self.pool.submit(self.compress, data, self.level))
+
+	def _drain(self):
+		data = self.pending.popleft().result()
+		self.file.write(data)
+		self.written += len(data)
+
+	def writable(self):
+		return True
+
+	def write(self, b):
+		"""
+		Queues bytes for compression, and writes out the chunks which were compressed in the meantime.
+		Returns the number of bytes taken, which is always all of them.
+		"""
+
+		self.buffer   += b
+		self.position += len(b)
+
+		if len(self.buffer) >= self.chunk:
+			view = memoryview(self.buffer)
+
+			for pos in range(0, len(self.buffer) - self.chunk + 1, self.chunk):
+				self._submit(bytes(view[pos:pos + self.chunk]))
+
+			view.release()
+			del self.buffer[:pos + self.chunk]
+
+		while len(self.pending) > 0 and self.pending[0].done():
+			self._drain()
+
+		return len(b)
+
+	def tell(self):
+		return self.position
+
+	def close(self):
+		if self.closed:
+			return
+
+		try:
+			if len(self.buffer) > 0 or self.position == 0:
+				self._submit(bytes(self.buffer))
+
+			while len(self.pending) > 0:
+				self._drain()
+
+		finally:
+			for future in self.pending:
+				future.cancel()
+
+			self.pool.shutdown(wait = True)
+			self.file.close()
+
+			io.RawIOBase.close(self)
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# coding=utf-8
+import io
+import sys
+import struct
+import tarfile
+import os.path
+import threading
+import concurrent.futures
+
+from ntfsea import ntfsea, lxattrb, stmode
+from decompress import ParallelWriter
+from utils import Fore, parse_image_arg, probe_wsl, get_label, handle_sigint, path_trans, escape_ntfs_invalid, clear_progress, Manifest, ProgressReporter
+
+# handle arguments
+
+handle_sigint()
+
+imgarg  = ''
+output  = ''
+level   = None
+threads = min(8, os.cpu_count() or 1)
+
+if len(sys.argv) > 1:
+	for arg in sys.argv[1:]:
+		if arg.lower().startswith('--threads='):
+			try:
+				threads = max(1, int(arg[len('--threads='):]))
+			except ValueError:
+				imgarg = ''
+				break
+		elif arg.lower().startswith('--level='):
+			try:
+				level = min(9, max(0, int(arg[len('--level='):])))
+			except ValueError:
+				imgarg = ''
+				break
+		elif not imgarg:
+			imgarg = arg
+		elif not output:
+			output = arg
+
+if not imgarg:
+	print('usage: ./export.py [--threads=N] [--level=N] image[:tag] [output]')
+	print('\noptions:\n  --threads=N  Number of threads scanning the rootfs and compressing the tarball. (default: %d)' % threads)
+	print('  --level=N    Compression level from 0 to 9. (default: 6)')
+	print('\nThe output is compressed with gzip or xz based on its extension, which can be .tar, .tar.gz, .tgz,')
+	print('.tar.xz or .txz. It defaults to rootfs_image_tag.tar.gz, which install.py picks up as image:tag.')
+	sys.exit(-1)
+
+image, tag, fname, label = parse_image_arg(imgarg, False)
+
+if not output:
+	output = fname + '.tar.gz'
+
+if output.lower().endswith(('.tar.gz', '.tgz')):
+	compression = 'gz'
+elif output.lower().endswith(('.tar.xz', '.txz')):
+	compression = 'xz'
+elif output.lower().endswith('.tar'):
+	compression = None
+else:
+	print('%s[!]%s Unable to determine the compression of %s%s%s from its extension.' % (Fore.RED, Fore.RESET, Fore.BLUE, output, Fore.RESET))
+	sys.exit(-1)
+
+# sanity checks
+
+print('%s[*]%s Probing the Linux subsystem...' % (Fore.GREEN, Fore.RESET))
+
+basedir, lxpath, bashpath = probe_wsl()
+basedir = os.path.join(basedir, 'LocalState')
+path    = os.path.join(basedir, 'rootfs')
+
+if get_label(path) != label:
+	path = os.path.join(basedir, 'rootfs_' + label)
+
+if not os.path.isdir(path):
+	print('%s[!]%s The %s%s%s:%s%s%s rootfs is not installed.' % (Fore.RED, Fore.RESET, Fore.YELLOW, image, Fore.RESET, Fore.YELLOW, tag, Fore.RESET))
+	sys.exit(-1)
+
+print('%s[*]%s Linux subsystem OK.' % (Fore.GREEN, Fore.RESET))
+
+# the names containing characters forbidden in NTFS were escaped during the installation, which
+# can not be reversed from the escaped name alone, but the manifest has the original names. its
+# sizes also add up to roughly the size of the tarball, which is used for the progress bar.
+
+entries  = Manifest.read(path) or {}
+unescape = {}
+total    = 0
+
+for name, entry in entries.items():
+	total += entry.size + 512
+
+	if escape_ntfs_invalid(name) != name:
+		unescape[escape_ntfs_invalid(name)] = name
+
+del entries
+
+# scan the rootfs
+#
+# the directories are listed on a thread pool ahead of the writer, along with the lxattrb and the
+# stat of their entries, as these are all separate system calls on NTFS, which are slow, but run
+# without the GIL. the small files are read in the same go, since opening files is just as slow.
+# only a limited number of directories are scanned ahead, and the small files read along with
+# them are capped per directory, so memory use does not depend on the size of the tree.
+
+maxinline = 256 * 1024
+dirinline = 4 * 1024 * 1024
+ahead     = threads * 4
+
+print_lock = threading.Lock()
+
+def print_export_error(name, err):
+	with print_lock:
+		clear_progress()
+		print('%s[!]%s Failed to export %s: %s' % (Fore.YELLOW, Fore.RESET, name, err))
+
+def scan_dir(winpath):
+	"""
+	Lists a directory, reading the details of each entry.
+
+	:param winpath: Path to the directory.
+
+	:return: Sorted list of the name, stat, lxattrb and contents of each entry, or the error in place
+	         of the stat, if the entry could not be read. Contents are None, unless it is a small file.
+	"""
+
+	found  = []
+	budget = dirinline
+
+	with os.scandir(winpath) as it:
+		for entry in it:
+			try:
+				st    = entry.stat(follow_symlinks = False)
+				attrb = ntfsea.getattr(path_trans(entry.path), 'lxattrb')
+				data  = None
+
+				if attrb is not None:
+					attrb = lxattrb.parse(attrb)
+
+				if not entry.is_dir(follow_symlinks = False) and st.st_size <= maxinline and st.st_size <= budget:
+					with open(entry.path, 'rb') as f:
+						data = f.read()
+
+					budget -= len(data)
+
+				found.append((entry.name, st, attrb, data))
+
+			except (OSError, struct.error) as err:
+				found.append((entry.name, err, None, None))
+
+	found.sort(key = lambda item: item[0])
+	return found
+
+# write the tarball
+
+print('%s[*]%s Exporting %s%s%s to %s%s%s...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, os.path.basename(path), Fore.RESET, Fore.BLUE, output, Fore.RESET))
+
+ntfsea.init()
+
+# the tarball is written under a temporary name, and only renamed once it is complete, as install.py
+# would take a tarball cut off at a member boundary for a complete one
+
+partial  = output + '.part'
+pool     = concurrent.futures.ThreadPoolExecutor(threads)
+progress = None
+exported = 0
+skipped  = 0
+links    = {}
+stack    = []
+done     = False
+
+try:
+	if compression is None:
+		fileobj = open(partial, 'wb')
+	else:
+		fileobj = ParallelWriter(partial, threads, compression, level)
+
+	progress = ProgressReporter(sample = lambda: (fileobj.tell(), max(total, fileobj.tell()))).start()
+
+	with fileobj, tarfile.open(fileobj = fileobj, mode = 'w', format = tarfile.PAX_FORMAT, errors = 'surrogateescape', copybufsize = 1024 * 1024) as tar:
+
+		# directories are visited depth-first, with the ones coming up next being scanned ahead
+
+		stack    = [('', path, None)]
+		inflight = 0
+
+		while stack:
+			for i in range(len(stack) - 1, -1, -1):
+				if inflight >= ahead:
+					break
+
+				if stack[i][2] is None:
+					stack[i] = (stack[i][0], stack[i][1], pool.submit(scan_dir, stack[i][1]))
+					inflight += 1
+
+			arcdir, windir, future = stack.pop()
+			inflight -= 1
+
+			try:
+				found = future.result()
+
+			except OSError as err:
+				print_export_error(arcdir or '/', err)
+				continue
+
+			subdirs = []
+
+			for name, st, attrb, data in found:
+				winpath = windir + '/' + name
+
+				# skip the metadata of the switcher, it is recreated during installation
+
+				if not arcdir and name.startswith('.switch_'):
+					continue
+
+				arcname = unescape.get(winpath[len(path) + 1:]) or (arcdir + '/' + name if arcdir else name)
+				progress.name = arcname
+
+				if isinstance(st, OSError):
+					print_export_error(arcname, st)
+					continue
+
+				isdir = stmode.isdir(st.st_mode)
+
+				# entries without lxattrb get the same defaults as the ones applied by install.py --rescan-attrs
+
+				if attrb is None:
+					attrb = lxattrb((stmode.FDIR if isdir else stmode.FREG) | 0o755, 0, 0, 0, int(st.st_mtime), int(st.st_mtime), int(st.st_mtime))
+
+				info       = tarfile.TarInfo(arcname)
+				info.mode  = attrb.mode & 0o7777
+				info.uid   = attrb.uid
+				info.gid   = attrb.gid
+				info.mtime = attrb.mtime
+				source     = None
+
+				try:
+					if isdir:
+						info.type = tarfile.DIRTYPE
+						subdirs.append((arcname, winpath, None))
+
+					elif stmode.issym(attrb.mode):
+
+						# symlinks are stored as regular files with the target as their contents
+
+						if data is None:
+							with open(winpath, 'rb') as f:
+								data = f.read()
+
+						info.type     = tarfile.SYMTYPE
+						info.linkname = data.decode('utf-8', 'surrogateescape')
+
+					elif stmode.isfifo(attrb.mode):
+						info.type = tarfile.FIFOTYPE
+
+					elif not stmode.isfile(attrb.mode) and attrb.mode & stmode.IFMT != 0:
+
+						# device files and sockets are not installed either
+
+						skipped += 1
+						continue
+
+					elif st.st_nlink > 1 and st.st_ino and (st.st_dev, st.st_ino) in links:
+
+						# hard links created within WSL, which can only be told apart where the
+						# file system reports inode numbers without opening the file
+
+						info.type     = tarfile.LNKTYPE
+						info.linkname = links[(st.st_dev, st.st_ino)]
+
+					else:
+						if st.st_nlink > 1 and st.st_ino:
+							links[(st.st_dev, st.st_ino)] = arcname
+
+						if data is not None:
+							source = io.BytesIO(data)
+							info.size = len(data)
+						else:
+							source = open(winpath, 'rb')
+							info.size = os.fstat(source.fileno()).st_size
+
+				except OSError as err:
+					print_export_error(arcname, err)
+					continue
+
+				# the entry can not be skipped anymore once its header is written, so errors are fatal from here on
+
+				try:
+					tar.addfile(info, source)
+					exported += 1
+
+				finally:
+					if source is not None:
+						source.close()
+
+			stack.extend(reversed(subdirs))
+
+	os.replace(partial, output)
+	done = True
+
+except OSError as err:
+	if progress is not None:
+		progress.stop()
+
+	print('%s[!]%s Failed to write %s%s%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, output, Fore.RESET, err))
+	sys.exit(-1)
+
+finally:
+	for arcdir, windir, future in stack:
+		if future is not None:
+			future.cancel()
+
+	pool.shutdown(wait = True)
+
+	if not done:
+		try:
+			os.remove(partial)
+		except OSError:
+			pass
+
+progress.stop()
+
+if skipped > 0:
+	print('%s[!]%s Skipped %d device files and sockets.' % (Fore.YELLOW, Fore.RESET, skipped))
+
+print('%s[*]%s Exported %d entries into %s%s%s (%.2f MB).' % (Fore.GREEN, Fore.RESET, exported, Fore.BLUE, output, Fore.RESET, os.path.getsize(output) / 1024 / 1024))
@@ -2,50 +2,90 @@
 # coding=utf-8
 import os
 import sys
-import json
 import time
-import urllib.request
-from utils import Fore, parse_image_arg, chunked_copy, clear_progress, handle_sigint, ensure_ca_load
+import shutil
+import http.client
+import urllib.error
+import concurrent.futures
+from utils import Fore, parse_image_arg, format_throughput, handle_sigint, ensure_ca_load, spawn_install, abort_install, BlobCache, RegistryClient, ProgressReporter
 
 # handle arguments
 
 handle_sigint()
 ensure_ca_load()
 
-if len(sys.argv) < 2:
-	print('usage: ./get-prebuilt.py image[:tag]')
+imgarg    = ''
+install   = False
+keep      = False
+instargs  = []
+cachedir  = os.path.join(os.getenv('LocalAppData') or os.path.expanduser('~'), 'WSL-Distribution-Switcher', 'blobs')
+cachesize = 4096
+jobs      = 4
+registry  = 'https://registry.hub.docker.com'
+authurl   = 'https://auth.docker.io/token?service=registry.docker.io&scope=repository:%s:pull'
+
+for arg in sys.argv[1:]:
+	if arg.lower() == '--install':
+		install = True
+	elif arg.lower() == '--keep':
+		keep = True
+	elif arg.lower() == '--no-cache':
+		cachedir = ''
+	elif arg.lower().startswith('--cache-dir='):
+		cachedir = arg[len('--cache-dir='):]
+	elif arg.lower().startswith('--cache-size=') or arg.lower().startswith('--jobs='):
+		try:
+			value = int(arg[arg.index('=') + 1:])
+		except ValueError:
+			imgarg = ''
+			break
+
+		if arg.lower().startswith('--jobs='):
+			jobs = max(1, value)
+		else:
+			cachesize = value
+	elif arg.lower().startswith('--registry='):
+		registry = arg[len('--registry='):]
+	elif arg.lower().startswith('--auth-url='):
+		authurl = arg[len('--auth-url='):]
+	elif arg.startswith('--'):
+		instargs.append(arg)
+	elif not imgarg:
+		imgarg = arg
+
+if not imgarg:
+	print('usage: ./get-prebuilt.py [--install [--keep] [install.py options]] [--no-cache | --cache-dir=PATH] [--cache-size=MB] [--jobs=N] [--registry=URL] [--auth-url=URL] image[:tag]')
+	print('\noptions:\n  --install       Installs the layers while they are being downloaded, without saving them.')
+	print('  --keep          Saves the archive as well when installing.')
+	print('  --no-cache      Downloads all layers, without consulting or populating the layer cache.')
+	print('  --cache-dir=    Directory of the layer cache. (default: %s)' % cachedir)
+	print('  --cache-size=   Size of the layer cache in megabytes, before evicting least recently used layers. (default: %d)' % cachesize)
+	print('  --jobs=         Number of layers to download at the same time. (default: %d)' % jobs)
+	print('  --registry=     Base URL of the registry to download from. (default: %s)' % registry)
+	print('  --auth-url=     URL of the token service, with %%s in place of the image name, or empty for none.')
 	sys.exit(-1)
 
-image, tag, fname, label = parse_image_arg(sys.argv[1], False)
+image, tag, fname, label = parse_image_arg(imgarg, False)
 
 fimage = image if '/' in image else 'library/' + image
-token  = ''
-expire = 0
+client = RegistryClient(fimage, registry, authurl)
 
 # get auth token to Docker Hub
 
-def request_auth_token():
-	global token, expire, fimage
-
+if authurl:
 	print('%s[*]%s Requesting authorization token...' % (Fore.GREEN, Fore.RESET))
 
 	try:
-		with urllib.request.urlopen('https://auth.docker.io/token?service=registry.docker.io&scope=repository:%s:pull' % fimage) as f:
-
-			data   = json.loads(f.read().decode('utf-8'))
-			token  = data['token']
-			expire = time.time() + data['expires_in']
+		client.refresh_token()
 
 	except urllib.error.HTTPError as err:
 		print('%s[!]%s Failed to authorization token: %s' % (Fore.RED, Fore.RESET, err))
 		sys.exit(-1)
 
-	except KeyError as err:
+	except (KeyError, ValueError, OSError) as err:
 		print('%s[!]%s Failed to authorization token: %s' % (Fore.RED, Fore.RESET, err))
 		sys.exit(-1)
 
-request_auth_token()
-
 # get the image manifest
 
 print('%s[*]%s Fetching manifest info for %s%s%s:%s%s%s...' % (Fore.GREEN, Fore.RESET, Fore.YELLOW, image, Fore.RESET, Fore.YELLOW, tag, Fore.RESET))
@@ -53,56 +93,183 @@ print('%s[*]%s Fetching manifest info for %s%s%s:%s%s%s...' % (Fore.GREEN, Fore.
 manifest = {}
 
 try:
-	r = urllib.request.Request('https://registry.hub.docker.com/v2/%s/manifests/%s' % (fimage, tag))
-	r.add_header('Authorization', 'Bearer ' + token)
-
-	with urllib.request.urlopen(r) as f:
+	manifest = client.get_manifest(tag)
 
-		manifest = json.loads(f.read().decode('utf-8'))
-
-		if len(manifest['fsLayers']) == 0:
-			print('%s[!]%s Manifest for image %s%s%s has no layers.' % (Fore.RED, Fore.RESET, Fore.BLUE, image, Fore.RESET))
-			sys.exit(-1)
+	if len(manifest['fsLayers']) == 0:
+		print('%s[!]%s Manifest for image %s%s%s has no layers.' % (Fore.RED, Fore.RESET, Fore.BLUE, image, Fore.RESET))
+		sys.exit(-1)
 
 except urllib.error.HTTPError as err:
 	print('%s[!]%s Failed to fetch manifest info for %s%s%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, image, Fore.RESET, err))
 	sys.exit(-1)
 
-# download the layers
+except (KeyError, ValueError, OSError) as err:
+	print('%s[!]%s Failed to fetch manifest info for %s%s%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, image, Fore.RESET, err))
+	sys.exit(-1)
+
+# the manifest lists the layers starting from the most recent one, but they have to be
+# written starting with the base layer, so the files of later layers overwrite earlier ones
+
+layers = []
+
+for layer in reversed(manifest['fsLayers']):
+	if layer['blobSum'] not in layers:
+		layers.append(layer['blobSum'])
+
+# download the layers, and pipe them into install.py if requested
+
+fname  += '.tar.gz'
+save    = not install or keep
+proc    = None
+tempdir = None
+
+try:
+	if cachedir:
+		cache = BlobCache(cachedir, cachesize * 1024 * 1024)
 
-dled   = set()
-fname += '.tar.gz'
+	else:
+
+		# without the cache, the layers are still downloaded into a temporary directory,
+		# as they may arrive out of order, which is kept until the archive is complete,
+		# so interrupted downloads can be resumed by running the script again
+
+		tempdir = fname + '.layers'
+		cache   = BlobCache(tempdir, 0)
+
+except OSError as err:
+	print('%s[!]%s Failed to open layer cache %s%s%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, cachedir, Fore.RESET, err))
+	sys.exit(-1)
+
+def download_layer(digest):
+	"""
+	Downloads a layer into the cache.
+
+	:param digest: Digest of the layer.
+
+	:return: Path to the downloaded layer.
+	"""
+
+	with cache.open(digest) as w:
+		client.fetch_blob(digest, w, w.offset)
+
+	return w.path
+
+# start downloading the layers which are not cached yet
+
+pool    = concurrent.futures.ThreadPoolExecutor(max_workers = jobs)
+start   = time.monotonic()
+futures = {}
+
+for digest in layers:
+	if cache.get(digest) is None:
+		futures[digest] = pool.submit(download_layer, digest)
+
+		if not install:
+			print('%s[*]%s Downloading layer %s%s%s...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, digest, Fore.RESET))
+
+	elif not install:
+		print('%s[*]%s Using cached layer %s%s%s...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, digest, Fore.RESET))
 
 # remove old file before download
-if os.path.exists(fname):
+if save and os.path.exists(fname):
 	os.remove(fname)
 
-for layer in manifest['fsLayers']:
-	if expire <= time.time():
-		request_auth_token()
+if install:
+	proc = spawn_install(imgarg, 0, instargs)
 
-	if layer['blobSum'] in dled:
-		continue
+# display the progress of all the downloads together, while install.py displays its own
 
-	dled.add(layer['blobSum'])
+progress = ProgressReporter(name = fname, sample = lambda: (client.received, client.total))
 
-	print('%s[*]%s Downloading layer %s%s%s...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, layer['blobSum'], Fore.RESET))
+if futures and not install:
+	progress.start()
 
-	try:
-		r = urllib.request.Request('https://registry.hub.docker.com/v2/%s/blobs/%s' % (fimage, layer['blobSum']))
-		r.add_header('Authorization', 'Bearer ' + token)
+# assemble the archive from the layers in order, as they finish downloading
 
-		with urllib.request.urlopen(r) as u, open(fname, 'ab') as f:
-			chunked_copy(fname, u, f)
+failed = True
 
-	except urllib.error.HTTPError as err:
-		clear_progress()
-		print('%s[!]%s Failed to download layer %s%s%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, layer['blobSum'], Fore.RESET, err))
-		sys.exit(-1)
+try:
+	for digest in layers:
+		try:
+			if digest in futures:
+				future = futures[digest]
 
-	except OSError as err:
-		clear_progress()
-		print('%s[!]%s Failed to open file %s%s%s for writing: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, fname, Fore.RESET, err))
-		sys.exit(-1)
+				# wait with a timeout, as waiting indefinitely can't be interrupted with Ctrl-C on Windows
+
+				while not future.done():
+					concurrent.futures.wait([future], timeout = 0.1)
+
+				blob = future.result()
+
+			else:
+				blob = cache.blob_path(digest)
+
+			with open(blob, 'rb') as b:
+				if install:
+					shutil.copyfileobj(b, proc.stdin, 1024 * 1024)
+					b.seek(0)
+
+				if save:
+					with open(fname, 'ab') as f:
+						shutil.copyfileobj(b, f, 1024 * 1024)
+
+		except urllib.error.HTTPError as err:
+			progress.stop()
+			print('%s[!]%s Failed to download layer %s%s%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, digest, Fore.RESET, err))
+			sys.exit(-1)
+
+		except (ValueError, http.client.HTTPException, ConnectionError, TimeoutError) as err:
+			progress.stop()
+			print('%s[!]%s Failed to download layer %s%s%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, digest, Fore.RESET, err))
+			sys.exit(-1)
+
+		except BrokenPipeError:
+			raise
+
+		except OSError as err:
+			progress.stop()
+			print('%s[!]%s Failed to open file %s%s%s for writing: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, fname, Fore.RESET, err))
+			sys.exit(-1)
+
+	progress.stop()
+
+	if futures and not install:
+		print('%s[*]%s Downloaded %s.' % (Fore.GREEN, Fore.RESET, format_throughput(client.received, time.monotonic() - start)))
+
+	if install:
+		proc.stdin.close()
+
+	failed = False
+
+except BrokenPipeError:
+
+	# install.py terminated early, its exit code and messages are what matter
+	failed = False
+
+finally:
+	progress.stop()
+	client.close()
+
+	# on failure, the remaining layers are not needed anymore, and install.py must not get to
+	# the end of its input, as the layers piped into it so far pass for a complete archive
+
+	if failed and install:
+		abort_install(proc)
+
+	if failed:
+		for future in futures.values():
+			future.cancel()
+
+	pool.shutdown(wait = not failed)
+
+# keep the cache under budget, without evicting the layers of this image
+
+if tempdir:
+	shutil.rmtree(tempdir, ignore_errors = True)
+else:
+	cache.evict(layers)
+
+if install:
+	sys.exit(proc.wait())
 
 print('%s[*]%s Rootfs archive for %s%s%s:%s%s%s saved to %s%s%s.' % (Fore.GREEN, Fore.RESET, Fore.YELLOW, image, Fore.RESET, Fore.YELLOW, tag, Fore.RESET, Fore.GREEN, fname, Fore.RESET))
@@ -1,19 +1,39 @@
 #!/usr/bin/env python3
 # coding=utf-8
+import os
 import sys
+import time
+import http.client
 import urllib.request
-from utils import Fore, parse_image_arg, chunked_copy, clear_progress, handle_sigint, ensure_ca_load
+from utils import Fore, parse_image_arg, resumable_copy, format_throughput, clear_progress, handle_sigint, ensure_ca_load, spawn_install, abort_install, TeeFileObject
 
 # handle arguments
 
 handle_sigint()
 ensure_ca_load()
 
-if len(sys.argv) < 2:
-	print('usage: ./get-source.py image[:tag]')
+imgarg   = ''
+install  = False
+keep     = False
+instargs = []
+
+for arg in sys.argv[1:]:
+	if arg.lower() == '--install':
+		install = True
+	elif arg.lower() == '--keep':
+		keep = True
+	elif arg.startswith('--'):
+		instargs.append(arg)
+	elif not imgarg:
+		imgarg = arg
+
+if not imgarg:
+	print('usage: ./get-source.py [--install [--keep] [install.py options]] image[:tag]')
+	print('\noptions:\n  --install   Installs the archive while it is being downloaded, without saving it.')
+	print('  --keep      Saves the archive as well when installing.')
 	sys.exit(-1)
 
-image, tag, fname, label = parse_image_arg(sys.argv[1], False)
+image, tag, fname, label = parse_image_arg(imgarg, False)
 
 dfurl = ''
 tgurl = ''
@@ -117,7 +137,7 @@ try:
 
 except urllib.error.HTTPError as err:
 	print('%s[!]%s Failed to fetch official-images info for %s%s%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, image, Fore.RESET, err))
-	print('%s[!]%s If this is not an official image, try getting it with %sget-prebuilt.py %s%s.' % (Fore.RED, Fore.RESET, Fore.GREEN, sys.argv[1].strip(), Fore.RESET))
+	print('%s[!]%s If this is not an official image, try getting it with %sget-prebuilt.py %s%s.' % (Fore.RED, Fore.RESET, Fore.GREEN, imgarg.strip(), Fore.RESET))
 	sys.exit(-1)
 
 # process Dockerfile
@@ -149,17 +169,99 @@ except urllib.error.HTTPError as err:
 	print('%s[!]%s Failed to fetch Dockerfile from %s%s%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, dfurl, Fore.RESET, err))
 	sys.exit(-1)
 
-# download rootfs archive
+# download rootfs archive, and pipe it into install.py if requested
 
-print('%s[*]%s Downloading archive %s%s%s...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, tgurl, Fore.RESET))
+def open_archive(offset):
+	"""
+	Opens the archive for downloading.
+
+	:param offset: Offset to request the rest of the archive from, or 0 for the whole archive.
+
+	:return: HTTP response.
+	"""
+
+	r = urllib.request.Request(tgurl)
+
+	if offset:
+		r.add_header('Range', 'bytes=%d-' % offset)
+
+	return urllib.request.urlopen(r)
+
+if install:
+	print('%s[*]%s Downloading and installing archive %s%s%s...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, tgurl, Fore.RESET))
+
+	try:
+		with open_archive(0) as u:
+			proc   = spawn_install(imgarg, int(u.info()['Content-Length'] or 0), instargs)
+			f      = None
+			failed = True
+
+			try:
+				f = open(fname, 'wb') if keep else None
+				resumable_copy(fname, open_archive, TeeFileObject(proc.stdin, f), 0, False, u)
+				proc.stdin.close()
+				failed = False
+
+			except BrokenPipeError:
+
+				# install.py terminated early, its exit code and messages are what matter
+				failed = False
+
+			finally:
+
+				# install.py must not get to the end of its input, as the archive may have been
+				# cut off where it passes for a complete one
+
+				if failed:
+					abort_install(proc)
+
+				if f is not None:
+					f.close()
+
+			sys.exit(proc.wait())
+
+	except (urllib.error.URLError, http.client.HTTPException, ValueError, ConnectionError, TimeoutError) as err:
+		print('%s[!]%s Failed to download archive from %s%s%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, tgurl, Fore.RESET, err))
+		sys.exit(-1)
+
+	except OSError as err:
+		print('%s[!]%s Failed to open file %s%s%s for writing: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, fname, Fore.RESET, err))
+		sys.exit(-1)
+
+# download into a partial file first, which is resumed if the script is interrupted and run again
+
+part   = fname + '.part'
+offset = os.path.getsize(part) if os.path.exists(part) else 0
+
+if offset:
+	print('%s[*]%s Resuming download of archive %s%s%s at %0.2f MB...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, tgurl, Fore.RESET, offset / 1024 / 1024))
+else:
+	print('%s[*]%s Downloading archive %s%s%s...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, tgurl, Fore.RESET))
 
 try:
-	with urllib.request.urlopen(tgurl) as u, open(fname, 'wb') as f:
-		chunked_copy(fname, u, f)
+	start = time.monotonic()
+
+	with open(part, 'ab') as f:
+		recv = resumable_copy(fname, open_archive, f, offset) - offset
+
+	os.replace(part, fname)
+
+	print('%s[*]%s Downloaded %s.' % (Fore.GREEN, Fore.RESET, format_throughput(recv, time.monotonic() - start)))
 
 except urllib.error.HTTPError as err:
 	clear_progress()
 	print('%s[!]%s Failed to download archive from %s%s%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, tgurl, Fore.RESET, err))
+
+	# the partial file is complete or does not belong to the current archive
+
+	if err.code == 416:
+		os.remove(part)
+
+	sys.exit(-1)
+
+except (urllib.error.URLError, http.client.HTTPException, ValueError, ConnectionError, TimeoutError) as err:
+	clear_progress()
+	print('%s[!]%s Failed to download archive from %s%s%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, tgurl, Fore.RESET, err))
 	sys.exit(-1)
 
 except OSError as err:
@@ -3,19 +3,22 @@
 import re
 import sys
 import stat
+import struct
 import time
 import atexit
 import shutil
 import tarfile
 import os.path
+import posixpath
 import subprocess
 
 from collections import OrderedDict
 from ntfsea import ntfsea, lxattrb, stmode
+from decompress import ParallelReader
 from utils import *
 
 try:
-	import PySquashfsImage
+	from squashfs import StreamingSquashFsImage, BlockCache
 	havesquashfs = True
 except ImportError:
 	havesquashfs = False
@@ -26,20 +29,77 @@ handle_sigint()
 
 imgarg   = ''
 runhooks = True
+rescan   = False
+stdin    = False
+layers   = False
+update   = False
+hashes   = False
+size     = 0
+timeout  = 0
+threads  = min(8, os.cpu_count() or 1)
+blockmb  = 16
 
 if len(sys.argv) > 1:
 	for arg in sys.argv[1:]:
 		if arg.lower() == '--no-hooks':
 			runhooks = False
+		elif arg.lower() == '--rescan-attrs':
+			rescan = True
+		elif arg.lower() == '--stdin':
+			stdin = True
+		elif arg.lower() == '--merge-layers':
+			layers = True
+		elif arg.lower() == '--update':
+			update = True
+		elif arg.lower() == '--hash':
+			hashes = True
+		elif arg.lower().startswith('--size='):
+			try:
+				size = int(arg[len('--size='):])
+			except ValueError:
+				imgarg = ''
+				break
+		elif arg.lower().startswith('--hook-timeout='):
+			try:
+				timeout = max(0, int(arg[len('--hook-timeout='):]))
+			except ValueError:
+				imgarg = ''
+				break
+		elif arg.lower().startswith('--threads='):
+			try:
+				threads = max(1, int(arg[len('--threads='):]))
+			except ValueError:
+				imgarg = ''
+				break
+		elif arg.lower().startswith('--block-cache='):
+			try:
+				blockmb = max(0, int(arg[len('--block-cache='):]))
+			except ValueError:
+				imgarg = ''
+				break
 		elif not imgarg:
 			imgarg = arg
 
 if not imgarg:
-	print('usage: ./install.py [--no-hooks] image[:tag] | tarball | squashfs')
-	print('\noptions:\n  --no-hooks    Omits running the hook scripts.')
+	print('usage: ./install.py [--no-hooks] [--rescan-attrs] [--threads=N] [--merge-layers] [--update] [--hash] [--hook-timeout=N] [--block-cache=MB] image[:tag] | tarball | squashfs')
+	print('       ./install.py --stdin [--size=N] [options] image[:tag]')
+	print('\noptions:\n  --no-hooks      Omits running the hook scripts.')
+	print('  --rescan-attrs  Walks the extracted tree and applies a default lxattrb to entries missing one.')
+	print('  --threads=N     Number of threads writing files during tarball extraction. (default: %d)' % threads)
+	print('  --merge-layers  Extracts only the final version of each file from a tarball of concatenated layers,')
+	print('                  and applies the whiteouts of the layers instead of writing them as files.')
+	print('  --update        Updates the backed up rootfs of the same image in place, only writing the entries which')
+	print('                  changed, and removing the ones the previous installation had which are not in the archive anymore.')
+	print('  --hash          Records the sha256 of the contents of the files in the manifest of the rootfs.')
+	print('  --hook-timeout=N')
+	print('                  Stops each hook script after N seconds, if the rootfs has the timeout command.')
+	print('  --block-cache=MB')
+	print('                  Memory for keeping decompressed SquashFS blocks shared between files, 0 to disable. (default: %d)' % blockmb)
+	print('  --stdin         Extracts the tarball piped into the standard input, as it arrives.')
+	print('  --size=N        Size of the tarball piped into the standard input, for the progress bar.')
 	sys.exit(-1)
 
-image, tag, fname, label = parse_image_arg(imgarg, True)
+image, tag, fname, label = parse_image_arg(imgarg, not stdin)
 
 # sanity checks
 
@@ -53,6 +113,18 @@ rootfstempdir = os.path.join(basedir, 'rootfs-temp')
 
 print('%s[*]%s Linux subsystem OK.' % (Fore.GREEN, Fore.RESET))
 
+# finish or revert a switch which was interrupted by the previous run
+
+try:
+	recovered = recover_switch(basedir)
+
+	if recovered is not None:
+		print('%s[!]%s The previous switch was interrupted, and has been %s.' % (Fore.YELLOW, Fore.RESET, recovered))
+
+except OSError as err:
+	print('%s[!]%s Failed to recover the previous interrupted switch: %s' % (Fore.RED, Fore.RESET, err))
+	sys.exit(-1)
+
 
 
 uid      = 0
@@ -63,12 +135,8 @@ homedir  = ''
 homedirFQDN = ''
 
 try:
-	uid, gid, user = get_lxss_user()
-	if user == 'root':
-		isroot = True
-		homedir = '/root'
-	else:
-		homedir = '/home/' + user
+	uid, gid, user, homedir = get_lxss_user(rootfsdir)
+	isroot = user == 'root'
 
 	homedirFQDN = os.path.join(rootfsdir, homedir.lstrip('/'))
 
@@ -83,7 +151,7 @@ except BaseException as err:
 	sys.exit(-1)
 
 # check squashfs prerequisites
-fext = os.path.splitext(fname)[-1].lower()
+fext = os.path.splitext(fname)[-1].lower() if not stdin else ''
 
 if (fext == '.sfs' or fext == '.squashfs') and not havesquashfs:
 	print('%s[!]%s Module %sPySquashfsImage%s is not available. Install it with %spip3 install PySquashfsImage%s for SquashFS support.' % (Fore.RED, Fore.RESET, Fore.GREEN, Fore.RESET, Fore.GREEN, Fore.RESET))
@@ -151,8 +219,6 @@ if etcshadowroot:
 		print('%s[*]%s Copying password of user %s to root since most images have no sudoers' % (Fore.GREEN, Fore.RESET, user))
 		if not isroot:
 			etcshadowroot = etcshadowuser
-	else:
-		etcshadowroot = parts[1]
 
 # remove old remnants
 if os.path.exists(rootfstempdir):
@@ -172,56 +238,255 @@ if os.path.exists(rootfstempdir):
 	if os.path.exists(rootfstempdir):
 		print('%s[*]%s Failed to remove leftover %srootfs-temp%s.' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET))
 		sys.exit(-1)
+
+# in update mode, the backed up rootfs of the same image is updated where it is, instead of extracting
+# the archive into a new one, and then switched to. the current rootfs is not updated in place, as
+# an update failing halfway through would leave it broken, with nothing to roll back to
+
+target   = rootfstempdir
+previous = None
+
+if update:
+	if get_label(rootfsdir) == label:
+		print('%s[!]%s The current rootfs is %s%s%s:%s%s%s, which can not be updated in place, extracting it from scratch.' % (Fore.YELLOW, Fore.RESET, Fore.YELLOW, image, Fore.RESET, Fore.YELLOW, tag, Fore.RESET))
+		update = False
+	elif os.path.isdir(os.path.join(basedir, 'rootfs_' + label)):
+		target = os.path.join(basedir, 'rootfs_' + label)
+	else:
+		print('%s[!]%s No installed rootfs found for %s%s%s:%s%s%s, extracting it from scratch.' % (Fore.YELLOW, Fore.RESET, Fore.YELLOW, image, Fore.RESET, Fore.YELLOW, tag, Fore.RESET))
+		update = False
+
+# when updating, the entries are compared with the ones already on disk, and only the ones which
+# differ are written or have their lxattrb replaced. the paths of all the entries are collected,
+# so the entries of the previous installation which are no longer in the archive can be removed
+# afterwards, going by its manifest
+
+seen      = set()
+rewritten = []
+retagged  = []
+
+if update:
+	try:
+		previous = Manifest.read(target)
+
+	except (OSError, ValueError) as err:
+		print('%s[!]%s Failed to read the manifest of the installed rootfs: %s' % (Fore.YELLOW, Fore.RESET, err))
+
+	if previous is None:
+		print('%s[!]%s The installed rootfs has no manifest, entries which are not in the archive anymore will not be removed.' % (Fore.YELLOW, Fore.RESET))
+
+def update_entry(winpath, blocks, attrb):
+	"""
+	Updates an entry of the installed rootfs to match the archive.
+
+	:param winpath: Path of the entry.
+	:param blocks: Iterable of the contents of the file, or None for directories, which are created
+	               beforehand, and for files which are already the same.
+	:param attrb: lxattrb of the entry.
+	"""
+
+	if blocks is not None:
+
+		# a directory may have been replaced by a file
+
+		if os.path.isdir(winpath):
+			shutil.rmtree(winpath)
+
+		if update_file(winpath, blocks):
+			os.chmod(winpath, 0o777)
+			rewritten.append(winpath)
+
+	if ntfsea.getattr(path_trans(winpath), 'lxattrb') != attrb:
+		ntfsea.queueattr(path_trans(winpath), 'lxattrb', attrb)
+		retagged.append(winpath)
+
+def keep_unchanged(winpath, name, info, size):
+	"""
+	Determines whether a file of the installed rootfs is already the same as in the archive, without
+	reading its contents, by comparing its size, and the mode and mtime in its lxattrb, which WSL
+	updates whenever the file is changed, with the ones of the member. The file is recorded in the
+	manifest if so, with the hash recorded by the previous installation, when hashes are requested.
+
+	:param winpath: Path of the file.
+	:param name: Path of the file within the rootfs.
+	:param info: lxattrb instance of the member.
+	:param size: Size of the member.
+
+	:return: Whether the file is the same, and its contents do not have to be compared.
+	"""
+
+	if not stmode.isfile(info.mode):
+		return False
+
+	try:
+		st = os.lstat(winpath)
+
+		if not stat.S_ISREG(st.st_mode) or st.st_size != size:
+			return False
+
+		attrb = ntfsea.getattr(path_trans(winpath), 'lxattrb')
+
+		if attrb is None:
+			return False
+
+		attrb = lxattrb.parse(attrb)
+
+	except (OSError, struct.error):
+		return False
+
+	if attrb.mode != info.mode or attrb.mtime != info.mtime:
+		return False
+
+	digest = ''
+
+	if hashes:
+		entry = previous.get(name) if previous is not None else None
+
+		if entry is None or not entry.sha256 or entry.size != size or entry.mtime != info.mtime:
+			return False
+
+		digest = entry.sha256
+
+	manifest.add(name, info, size, digest)
+	return True
+
+def make_dirs(winpath):
+	"""
+	Creates a directory and its parents, replacing a file in its place when updating.
+
+	:param winpath: Path of the directory.
+	"""
+
+	try:
+		os.makedirs(winpath, exist_ok = True)
+
+	except FileExistsError:
+		if not update:
+			raise
+
+		os.remove(winpath)
+		os.makedirs(winpath)
+
 # extract archive
 
-print('%s[*]%s Beginning extraction...' % (Fore.GREEN, Fore.RESET))
+if update:
+	print('%s[*]%s Updating %s%s%s in place...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, os.path.basename(target), Fore.RESET))
+else:
+	print('%s[*]%s Beginning extraction...' % (Fore.GREEN, Fore.RESET))
+
+# the entries are recorded in the manifest of the rootfs as the writer threads finish them,
+# so the installed tree can be queried later without walking it
+
+make_dirs(target)
+manifest = Manifest(target, hashes)
+
+# the digest of the archive is calculated alongside the extraction, for the registry of the
+# installed distributions, except for piped archives, which can not be read again. it trails
+# right behind the extraction, hashing what was just read while it is still in the cache
+
+digest = None
+
+if not stdin:
+	digest = TrailingDigest(fname)
 
 if fext == '.sfs' or fext == '.squashfs':
 
 	# extract rootfs from SquashFS
+	#
+	# the blocks of the files are compressed independently, so the files are decompressed and
+	# written on the writer threads, while the directories are created on this thread as they
+	# are encountered, before any of the entries within them are queued.
+
+	def print_extract_error(name, err):
+		with progress_lock:
+			clear_progress()
+			print('%s[!]%s Failed to extract %s: %s' % (Fore.YELLOW, Fore.RESET, name, err))
+
+	def write_entry(winpath, name, file, info):
+		attrb = info.generate()
+
+		if file.isFolder():
+			blocks = None
+			manifest.add(name, info)
+		elif update and keep_unchanged(winpath, name, info, file.getLength()):
+			blocks = None
+		else:
+			blocks = manifest.track(name, info, img.iter_content(file.inode))
+
+		if update:
+			update_entry(winpath, blocks, attrb)
+			return
+
+		if blocks is not None:
+			with open(winpath, 'wb') as f:
+				for block in blocks:
+					f.write(block)
+
+		# apply lxattrb
+
+		os.chmod(winpath, 0o777)
+		ntfsea.queueattr(path_trans(winpath), 'lxattrb', attrb)
+
+	img      = None
+	pool     = WriterPool(threads, onerror = print_extract_error)
+	progress = None
 
 	try:
-		img  = PySquashfsImage.SquashFsImage(fname)
-		path = rootfstempdir
+		# keep the recently decompressed blocks, as files sharing a fragment block are
+		# generally next to each other
+
+		cache = BlockCache(blockmb * 1024 * 1024) if blockmb > 0 else None
+		img   = StreamingSquashFsImage(fname, cache = cache)
+		path  = target
+
+		if digest is not None:
+			digest.follow(lambda: img.frontier)
 
-		hide_cursor()
 		ntfsea.init()
 
-		i = 0
-		for file in img.root.findAll():
-			name = file.getPath().lstrip('./')
+		# display the number of entries the writer threads have finished
+
+		progress = ProgressReporter(sample = lambda: (pool.done, img.total_inodes), unit = 'files/s', scale = 1).start()
+
+		for file in img.walk():
+			name = member_path(file.getPath())
 			winpath = path + '/' + escape_ntfs_invalid(name)
 
-			draw_progress(i, img.total_inodes, name)
-			i += 1
+			progress.name = name
+
+			if update:
+				seen.add(winpath)
 
 			try:
+				if file.isFolder():
+					make_dirs(winpath)
 
-				# create directory or extract file
+				pool.submit(winpath, name, write_entry, winpath, name, file, lxattrb.fromsfs(file))
 
-				if file.isFolder():
-					os.makedirs(winpath, exist_ok = True)
+			except Exception as err:
+				print_extract_error(name, err)
 
-				else:
-					with open(winpath, 'wb') as f:
-						f.write(file.getContent())
+		pool.close()
+		progress.stop()
 
-				# apply lxattrb
+		if cache is not None:
+			print('%s[*]%s Block cache of %d MB: %d hits, %d misses.' % (Fore.GREEN, Fore.RESET, blockmb, cache.hits, cache.misses))
 
-				os.chmod(winpath, 0o777)
+		# write the remaining queued lxattrb entries
 
-				attrb = lxattrb.fromsfs(file).generate()
-				ntfsea.writeattr(path_trans(winpath), 'lxattrb', attrb)
+		fails = ntfsea.flushattrs()
 
-			except Exception as err:
-				clear_progress()
-				print('%s[!]%s Failed to extract %s: %s' % (Fore.YELLOW, Fore.RESET, name, err))
-				pass
+		if fails > 0:
+			print('%s[!]%s Failed to apply lxattrb to %d entries.' % (Fore.YELLOW, Fore.RESET, fails))
 
 	finally:
-		img.close()
-		clear_progress()
-		show_cursor()
+		pool.close()
+
+		if progress is not None:
+			progress.stop()
+
+		if img is not None:
+			img.close()
 
 else:
 
@@ -244,100 +509,320 @@ else:
 	tarfile.TarFile.OPEN_METH['tar'] = 'taropen'
 
 	# extract rootfs from tarball
+	#
+	# the archive is decoded on this thread, while the files are created, written and have their
+	# lxattrb applied on a pool of writer threads. directories and the parents of the entries are
+	# created here before the jobs are queued, so a job never runs ahead of its parent directory,
+	# and the pool serializes jobs of the same path, so a later member always wins.
+
+	# archives piped in by get-source.py or get-prebuilt.py with --install are extracted as they
+	# are being downloaded, while multi-member gzip archives, such as the ones assembled from layers
+	# by get-prebuilt.py, and multi-block xz archives are decompressed on multiple threads.
+	# uncompressed archives are memory mapped, and the contents of their members are written
+	# straight from the mapping
+
+	def open_archive():
+		if stdin:
+			fileobj = ProgressStreamObject(sys.stdin.buffer, size)
+			return fileobj, open_compressed_stream(fileobj), 'r|'
+		elif threads > 1 and ParallelReader.is_parallel(fname):
+			fileobj = ParallelReader(fname, threads)
+			return fileobj, fileobj, 'r|'
+		elif MappedFileObject.is_plain_tar(fname):
+			fileobj = MappedFileObject(fname)
+			return fileobj, fileobj, 'r:'
+		else:
+			fileobj = ProgressFileObject(fname)
+			return fileobj, fileobj, 'r:*'
+
+	def open_followed():
+		fileobj, tarfobj, tarmode = open_archive()
+
+		# the progress bars of the readers sample their position in the archive itself
+
+		if digest is not None:
+			digest.follow(lambda: fileobj.progress.sample()[0])
+
+		return fileobj, tarfobj, tarmode
+
+	# in order to only extract the final version of each file from an archive of concatenated layers,
+	# the whole archive is read through once beforehand, to see what the later layers overwrite
+
+	skip = set()
+
+	if layers:
+		if stdin:
+			print('%s[!]%s Layer-aware extraction is not available for piped archives, extracting all layers.' % (Fore.YELLOW, Fore.RESET))
+
+		else:
+			fileobj, tarfobj, tarmode = open_followed()
+			fileobj.progress.name = 'Indexing layers...'
+
+			try:
+				with tarfile.open(fileobj = tarfobj, mode = tarmode, ignore_zeros = True, errorlevel = 2) as tar:
+					skip, count = index_tar_layers(tar)
+
+			except Exception as err:
+				fileobj.progress.stop()
+				print('%s[!]%s Failed to index archive: %s' % (Fore.RED, Fore.RESET, err))
+				sys.exit(-1)
+
+			finally:
+				fileobj.close()
+
+			print('%s[*]%s Found %d layers, skipping %d overwritten or deleted entries.' % (Fore.GREEN, Fore.RESET, count, len(skip)))
+
+	fileobj, tarfobj, tarmode = open_followed()
+	fileobj.progress.name = 'Scanning archive...'
+	mapped = isinstance(fileobj, MappedFileObject)
+
+	# members larger than this are streamed to disk on this thread instead of being queued
+
+	maxqueued = 1024 * 1024
+
+	def print_extract_error(name, err):
+		with progress_lock:
+			clear_progress()
+			print('%s[!]%s Failed to extract %s: %s' % (Fore.YELLOW, Fore.RESET, name, err))
+
+	def write_member(winpath, name, data, info):
+		if data is None:
+			manifest.add(name, info)
+		elif update and keep_unchanged(winpath, name, info, len(data)):
+			data = None
+		else:
+			data = manifest.track(name, info, [data])
+
+		write_blocks(winpath, data, info.generate())
+
+	def stream_member(winpath, name, source, info, size):
+		if update and keep_unchanged(winpath, name, info, size):
+			write_blocks(winpath, None, info.generate())
+			return
+
+		# read large files in chunks on the writer thread, instead of holding them in memory
+
+		write_blocks(winpath, manifest.track(name, info, iter(lambda: source.read(maxqueued), b'')), info.generate())
+
+	def write_blocks(winpath, blocks, attrb):
+		if update:
+			update_entry(winpath, blocks, attrb)
+			return
+
+		if blocks is not None:
+			with open(winpath, 'wb') as f:
+				for block in blocks:
+					f.write(block)
+
+		# apply lxattrb
+
+		os.chmod(winpath, 0o777)
+		ntfsea.queueattr(path_trans(winpath), 'lxattrb', attrb)
+
+	def make_parents(dirname, name):
+
+		# record the directories which will be created implicitly, since they need a default lxattrb,
+		# unless they show up later as a member of the archive. their names within the rootfs are
+		# kept along for the manifest, since the escaped paths can not be reversed
 
-	fileobj = ProgressFileObject(fname)
-	fileobj.current_extraction = 'Scanning archive...'
+		parent = dirname
+
+		while parent not in dirs and len(parent) > len(path):
+			dirs.add(parent)
+			implicit.append((parent, name))
+			parent = os.path.dirname(parent)
+			name   = posixpath.dirname(name)
+
+		make_dirs(dirname)
+
+	pool = WriterPool(threads, onerror = print_extract_error)
 
 	try:
 		ntfsea.init()
-		path = rootfstempdir
-		with tarfile.open(fileobj = fileobj, mode = 'r:*', dereference = True, ignore_zeros = True, errorlevel = 2) as tar:
+		path = target
+
+		# directories known to exist, and the ones which were present as members of the archive
+
+		dirs     = {path}
+		explicit = set()
+		implicit = []
+
+		with tarfile.open(fileobj = tarfobj, mode = tarmode, dereference = True, ignore_zeros = True, errorlevel = 2) as tar:
 
 			file = tar.next()
 
 			if file is None:
-				clear_progress()
+				fileobj.progress.stop()
 				print('%s[!]%s Failed to extract archive: unable to determine archive type.' % (Fore.RED, Fore.RESET))
 				sys.exit(-1)
 
+			ordinal = -1
+
 			while file is not None:
 				try:
+					ordinal += 1
+
+					if ordinal in skip:
+						continue
+
+					name = member_path(file.name)
+					fileobj.progress.name = name
+					winpath = path + '/' + escape_ntfs_invalid(name)
+
+					if file.isdev():
+
+						# skip device files, such as /dev/*
+						continue
 
-					# extract file
+					if update:
+						seen.add(winpath)
 
-					file.name = file.name.lstrip('./')
-					fileobj.current_extraction = file.name
-					file.name = path + '/' + escape_ntfs_invalid(file.name)
+					info = lxattrb.fromtar(file)
+
+					if file.isdir():
+
+						# create directory right away, so the entries within can be queued
+
+						if winpath not in dirs:
+							make_parents(winpath, name)
+
+						explicit.add(winpath)
+						pool.submit(winpath, name, write_member, winpath, name, None, info)
+						continue
+
+					dirname = os.path.dirname(winpath)
+
+					if dirname not in dirs:
+						make_parents(dirname, posixpath.dirname(name))
 
 					if file.issym() or file.islnk():
 
 						# create symlink manually
+						#
+						# the linkname of a hardlink is relative to the root of the archive, so it is made
+						# absolute, or else the symlink will be broken because it will be interpreted as relative
 
-						dirname = os.path.dirname(file.name)
-						if not os.path.exists(dirname):
-							os.makedirs(dirname, exist_ok=True)
+						data = ('/' + member_path(file.linkname) if file.islnk() else file.linkname).encode('utf-8')
+						pool.submit(winpath, name, write_member, winpath, name, data, info)
 
-						# if a hardlink's linkname begins with a leading dot, the dot must be omitted,
-						# or else the symlink will be broken because it will be interpreted as relative
-						with open(file.name, 'w', encoding='utf-8') as link:
-							link.write(file.linkname.lstrip('.') if file.islnk() else file.linkname)
+					elif mapped and not file.issparse():
 
-					elif file.isdev():
+						# queue file for writing from the mapped archive, however large it is
 
-						# skip device files, such as /dev/*
-						continue
+						pool.submit(winpath, name, write_member, winpath, name, fileobj.slice(file.offset_data, file.size), info)
 
-					else:
+					elif file.size <= maxqueued:
 
-						# extract file
-						tar.extract(file, path)
+						# read contents and queue file for writing
 
-					# apply lxattrb
+						data = tar.extractfile(file).read()
+						pool.submit(winpath, name, write_member, winpath, name, data, info)
 
-					os.chmod(file.name, 0o777)
+					else:
 
-					attrb = lxattrb.fromtar(file).generate()
-					ntfsea.writeattr(path_trans(file.name), 'lxattrb', attrb)
+						# stream large files directly, instead of holding them in memory
+						pool.run(winpath, name, stream_member, winpath, name, tar.extractfile(file), info, file.size)
 
 				except Exception as err:
-					clear_progress()
-					print('%s[!]%s Failed to extract %s: %s' % (Fore.YELLOW, Fore.RESET, fileobj.current_extraction, err))
-					pass
+					print_extract_error(fileobj.progress.name, err)
 
 				finally:
 					file = tar.next()
 
+		pool.close()
+
 		# some archives don't seem to have the directories themselves as separate
 		# entries, and this results in lxattrb not being applied to them, which will
 		# lead to bash.exe returning Error: 0x80070002 or 0x8007001f
 
-		dattrb = lxattrb(stmode.FDIR | 0o755).generate()
+		dinfo  = lxattrb(stmode.FDIR | 0o755)
+		dattrb = dinfo.generate()
 		fattrb = lxattrb(stmode.FREG | 0o755).generate()
 
-		for root, subFolders, files in os.walk(path):
+		# apply generic root:root 0755 to the implicitly created directories
+
+		for folder, name in implicit:
+			if folder not in explicit:
+				ntfsea.queueattr(path_trans(folder), 'lxattrb', dattrb)
+				manifest.add(name, dinfo)
+
+		if update:
+			seen.update(dirs)
 
-			# apply generic root:root 0755 to those without an attribute
+		# write the remaining queued lxattrb entries
 
-			for folder in subFolders:
-				folder = path_trans(os.path.join(root, folder))
+		fails = ntfsea.flushattrs()
 
-				if ntfsea.getattr(folder, 'lxattrb') is None:
-					ntfsea.writeattr(folder, 'lxattrb', dattrb)
+		if fails > 0:
+			fileobj.progress.stop()
+			print('%s[!]%s Failed to apply lxattrb to %d entries.' % (Fore.YELLOW, Fore.RESET, fails))
 
-			for file in files:
-				file = path_trans(os.path.join(root, file))
+		# walking the whole tree doubles the metadata I/O, so only do it when asked
 
-				if ntfsea.getattr(file, 'lxattrb') is None:
-					ntfsea.writeattr(file, 'lxattrb', fattrb)
+		if rescan:
+			for root, subFolders, files in os.walk(path):
+
+				# apply generic root:root 0755 to those without an attribute
+
+				for folder in subFolders:
+					folder = path_trans(os.path.join(root, folder))
+
+					if ntfsea.getattr(folder, 'lxattrb') is None:
+						ntfsea.writeattr(folder, 'lxattrb', dattrb)
+
+				for file in files:
+					file = path_trans(os.path.join(root, file))
+
+					if ntfsea.getattr(file, 'lxattrb') is None:
+						ntfsea.writeattr(file, 'lxattrb', fattrb)
 
 	except Exception as err:
-		clear_progress()
+		fileobj.progress.stop()
 		print('%s[!]%s Failed to extract archive: %s' % (Fore.RED, Fore.RESET, err))
 		sys.exit(-1)
 
 	finally:
-		clear_progress()
-		show_cursor()
+		pool.close()
+		fileobj.close()
+
+# remove the entries of the previous installation which are not in the archive anymore. only the
+# entries recorded in its manifest are removed, so whatever was created in the rootfs since is left
+# alone, along with the contents of the home directories, which belong to the users and not to the
+# image. the children are removed before their parents, and directories are only removed when empty
+
+if update:
+	removed = 0
+
+	for name in sorted(previous or (), reverse = True):
+		entpath = target + '/' + escape_ntfs_invalid(name)
+
+		if not name or entpath in seen or name.split('/', 1)[0] in ('home', 'root'):
+			continue
+
+		try:
+			if previous[name].type == 'd':
+				os.rmdir(entpath)
+			else:
+				os.remove(entpath)
+
+			removed += 1
+
+		except FileNotFoundError:
+			pass
+
+		except OSError as err:
+			if previous[name].type == 'd' and os.path.isdir(entpath) and len(os.listdir(entpath)) > 0:
+				continue
+
+			print('%s[!]%s Failed to remove %s: %s' % (Fore.YELLOW, Fore.RESET, name, err))
+
+	print('%s[*]%s Rewrote %d files, updated the lxattrb of %d entries and removed %d entries.' % (Fore.GREEN, Fore.RESET, len(rewritten), len(retagged), removed))
+
+try:
+	manifest.close()
+
+except OSError as err:
+	print('%s[!]%s Failed to write the manifest of the rootfs: %s' % (Fore.YELLOW, Fore.RESET, err))
 
 # read label of current distribution
 
@@ -349,35 +834,31 @@ if not clabel:
 
 # do the switch
 
-print('%s[*]%s Backing up current %srootfs%s to %srootfs_%s%s...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, Fore.RESET, Fore.BLUE, clabel, Fore.RESET))
+print('%s[*]%s Backing up current %srootfs%s to %srootfs_%s%s and switching to new %srootfs%s...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, Fore.RESET, Fore.BLUE, clabel, Fore.RESET, Fore.BLUE, Fore.RESET))
 
-try:
-	subprocess.check_output(['cmd', '/C', 'move', path_trans(rootfsdir), path_trans(os.path.join(basedir, 'rootfs_' + clabel))])
-
-except subprocess.CalledProcessError as err:
-	print('%s[!]%s Failed to backup current %srootfs%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET, err))
-	sys.exit(-1)
-
-print('%s[*]%s Switching to new %srootfs%s...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, Fore.RESET))
-
-time.sleep(4)
+# an install interrupted between the two renames is reverted on the next run, since the
+# user entries and hooks were not applied to the new rootfs yet
 
 try:
-	subprocess.check_output(['cmd', '/C', 'move', path_trans(rootfstempdir), path_trans(rootfsdir)])
+	switch_rootfs(basedir, 'rootfs_' + clabel, target, forward = False)
 
-except subprocess.CalledProcessError as err:
-	print('%s[!]%s Failed to switch to new %srootfs%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET, err))
-	print('%s[*]%s Rolling back to old %srootfs%s...' % (Fore.YELLOW, Fore.RESET, Fore.BLUE, Fore.RESET))
+except SwitchError as err:
+	if err.step == 'backup':
+		print('%s[!]%s Failed to backup current %srootfs%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET, err))
 
-	try:
-		subprocess.check_output(['cmd', '/C', 'move', path_trans(os.path.join(basedir, 'rootfs_' + clabel)), path_trans(rootfsdir)])
+	elif err.step == 'switch':
+		print('%s[!]%s Failed to switch to new %srootfs%s, rolled back to old %srootfs%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET, Fore.BLUE, Fore.RESET, err))
 
-	except subprocess.CalledProcessError as err:
-		print('%s[!]%s Failed to roll back to old %srootfs%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET, err))
+	else:
+		print('%s[!]%s Failed to switch to new %srootfs%s, and to roll back to old %srootfs%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET, Fore.BLUE, Fore.RESET, err))
 		print('%s[!]%s You are now the proud owner of one broken Linux subsystem! To fix it, run %slxrun /uninstall%s and %slxrun /install%s from the command prompt.' % (Fore.RED, Fore.RESET, Fore.GREEN, Fore.RESET, Fore.GREEN, Fore.RESET))
 
 	sys.exit(-1)
 
+except OSError as err:
+	print('%s[!]%s Failed to write the switch journal: %s' % (Fore.RED, Fore.RESET, err))
+	sys.exit(-1)
+
 # save label
 
 try:
@@ -386,6 +867,18 @@ try:
 
 except OSError as err:
 	print('%s[!]%s Failed to open file %s/.switch_label%s for writing: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET, err))
+
+# record the installation in the registry of the installed distributions
+
+try:
+	registry = Registry(basedir)
+	registry.record(label, installed = int(time.time()), digest = digest.result() if digest is not None else '', size = sum(manifest.sizes.values()), entries = len(manifest.sizes))
+	registry.refresh()
+	registry.save()
+
+except OSError as err:
+	print('%s[!]%s Failed to update the registry of the installed distributions: %s' % (Fore.YELLOW, Fore.RESET, err))
+
 # append user entries to /etc/{passwd,shadow,group,gshadow}
 
 print('%s[*]%s Writing entries of %sroot%s%s to %s/etc/{passwd,shadow,group,gshadow,}%s...' % (Fore.GREEN, Fore.RESET, Fore.YELLOW, Fore.RESET, (' and %s%s%s' % (Fore.YELLOW, user, Fore.RESET) if not isroot else ''), Fore.BLUE, Fore.RESET))
@@ -442,19 +935,24 @@ if not isroot:
 	except OSError as err:
 		print('%s[!]%s Failed to open file %s/etc/gshadow%s for writing: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET, err))
 
+# the new rootfs has the same default user, so it will not have to be looked up in WSL next time
+
+try:
+	remember_lxss_user(rootfsdir, uid, gid, user, homedir)
+
+except OSError as err:
+	print('%s[!]%s Failed to update the registry of the installed distributions: %s' % (Fore.YELLOW, Fore.RESET, err))
+
 # check if post-install hooks exist
 
-havehooks = False
+hooks = []
 
 if runhooks:
-	hooks = ['all', image, image + '_' + tag]
+	for hook in ['all', image, image + '_' + tag]:
+		if os.path.isfile('hook_postinstall_%s.sh' % hook):
+			hooks.append(hook)
 
-	for hook in hooks:
-		hookfile = 'hook_postinstall_%s.sh' % hook
-
-		if os.path.isfile(hookfile):
-			havehooks = True
-			break
+havehooks = len(hooks) > 0
 
 # switch to root, if regular user and have hooks
 
@@ -492,6 +990,12 @@ if not isroot and havehooks:
 
 
 # run post-install hooks, if any
+#
+# starting bash.exe boots the distribution, so the hooks are written into the home directory
+# directly with their lxattrb, along with a script running them one after the other, and then
+# the whole batch runs in a single bash session. that script prints a marker line around each
+# hook, from which their exit codes and durations are taken, while the rest of the output is
+# passed through as it arrives.
 
 if havehooks:
 
@@ -507,43 +1011,126 @@ if havehooks:
 		else:
 			winver = 0
 
-	hooks = ['all', image, image + '_' + tag]
+	marker = '@@switch-hook-%s' % os.urandom(4).hex()
+	runner = '.switch_hooks.sh'
+	script = ('#!/bin/sh\n'
+	          'for hook in "$@"; do\n'
+	          '\techo "%s start $hook"\n'
+	          '\tif [ %d -gt 0 ] && command -v timeout > /dev/null; then\n'
+	          '\t\ttimeout %d "%s/$hook"\n'
+	          '\telse\n'
+	          '\t\t"%s/$hook"\n'
+	          '\tfi\n'
+	          '\tstatus=$?\n'
+	          '\techo "%s end $hook $status"\n'
+	          'done\n') % (marker, timeout, timeout, homedir, homedir, marker)
+
+	now     = int(time.time())
+	xattrb  = lxattrb(stmode.FREG | 0o755, 0, 0, 0, now, now, now).generate()
+	written = []
+	copied  = []
+
+	ntfsea.init()
+
+	def write_hook(hookfile, content):
+		hookpath = os.path.join(homedirFQDN, hookfile)
+
+		with open(hookpath, 'w', newline='\n') as f:
+			written.append(hookpath)
+			f.write(content)
+
+		ntfsea.writeattr(path_trans(hookpath), 'lxattrb', xattrb)
+
+	# a hook which could not be copied is skipped, while the others still run
 
 	for hook in hooks:
-		print("DEBUG: hook="+hook)
 		hookfile = 'hook_postinstall_%s.sh' % hook
 
-		if os.path.isfile(hookfile):
-			print('%s[*]%s Running post-install hook %s%s%s...' % (Fore.GREEN, Fore.RESET, Fore.GREEN, hook, Fore.RESET))
+		try:
+			with open(hookfile) as f:
+				write_hook(hookfile, f.read().replace('\r', ''))
 
-			hookpath = os.path.join(homedirFQDN, hookfile)
-			print("DEBUG: hookpath="+hookpath)
-			try:
-				subprocess.check_call(['cmd', '/C', path_trans(bashpath) + '\\bash.exe', '-c', 'echo -n > /root/%s && chmod +x /root/%s' % (hookfile, hookfile)])
+			copied.append(hook)
+
+		except OSError as err:
+			print('%s[!]%s Failed to copy hook %s%s%s to WSL: %s' % (Fore.RED, Fore.RESET, Fore.GREEN, hook, Fore.RESET, err))
+
+	hooks = copied
+
+	if hooks:
+		try:
+			write_hook(runner, script)
+
+		except OSError as err:
+			print('%s[!]%s Failed to copy hooks to WSL: %s' % (Fore.RED, Fore.RESET, err))
+			hooks = []
+
+	finished = []
+
+	if hooks:
+		print('%s[*]%s Running post-install hooks %s%s%s...' % (Fore.GREEN, Fore.RESET, Fore.GREEN, ', '.join(hooks), Fore.RESET))
+
+		command = 'REGULARUSER="%s" WINVER="%d" sh %s/%s %s' % (user if not isroot else '', winver, homedir, runner, ' '.join('hook_postinstall_%s.sh' % hook for hook in hooks))
+
+		try:
+			proc  = subprocess.Popen(['cmd', '/C', path_trans(bashpath) + '\\bash.exe', '-c', command], stdout = subprocess.PIPE, universal_newlines = True)
+			start = time.perf_counter()
 
-				if not os.path.isfile(hookpath):
-					print('%s[!]%s Failed to copy hook to WSL: File %s%s%s not present.' % (Fore.RED, Fore.RESET, Fore.BLUE, hookpath, Fore.RESET))
+			for line in proc.stdout:
+				output, found, line = line.partition(marker + ' ')
+
+				# the last line of a hook may lack a line break, and the marker is appended to it
+
+				if output:
+					sys.stdout.write(output if not found else output + '\n')
+					sys.stdout.flush()
+
+				if not found:
 					continue
 
-			except subprocess.CalledProcessError as err:
-				print('%s[!]%s Failed to run hook in WSL: %s' % (Fore.RED, Fore.RESET, err))
-				continue
+				parts = line.split()
 
-			try:
-				with open(hookfile) as s, open(hookpath, 'a', newline='\n') as d:
-					d.write(s.read().replace('\r', ''))
+				if not parts:
+					continue
 
-			except OSError as err:
-				print('%s[!]%s Failed to open hook: %s' % (Fore.RED, Fore.RESET, err))
-				continue
+				if parts[0] == 'start':
+					start = time.perf_counter()
+					continue
 
-			try:
-				subprocess.check_call(['cmd', '/C', path_trans(bashpath) + '\\bash.exe', '-c', 'REGULARUSER="%s" WINVER="%d" /root/%s' % (user if not isroot else '', winver, hookfile)])
+				if parts[0] != 'end' or len(parts) != 3:
+					continue
 
-			except subprocess.CalledProcessError as err:
-				print('%s[!]%s Failed to run hook in WSL: %s' % (Fore.RED, Fore.RESET, err))
-				continue
+				hook    = parts[1][len('hook_postinstall_'):-len('.sh')]
+				code    = int(parts[2])
+				elapsed = time.perf_counter() - start
+
+				finished.append(hook)
+
+				if code == 0:
+					print('%s[*]%s Hook %s%s%s finished in %.1f s.' % (Fore.GREEN, Fore.RESET, Fore.GREEN, hook, Fore.RESET, elapsed))
+				elif code == 124 and timeout > 0:
+					print('%s[!]%s Hook %s%s%s timed out after %.1f s.' % (Fore.RED, Fore.RESET, Fore.GREEN, hook, Fore.RESET, elapsed))
+				else:
+					print('%s[!]%s Hook %s%s%s failed with exit code %d after %.1f s.' % (Fore.RED, Fore.RESET, Fore.GREEN, hook, Fore.RESET, code, elapsed))
 
+			# the script running the hooks always exits with 0, unless bash.exe failed to start or was killed
+
+			status = proc.wait()
+
+			if status != 0:
+				print('%s[!]%s Running the hooks in WSL failed with exit code %d.' % (Fore.RED, Fore.RESET, status))
+
+		except OSError as err:
+			print('%s[!]%s Failed to run hooks in WSL: %s' % (Fore.RED, Fore.RESET, err))
+
+	for hook in hooks:
+		if hook not in finished:
+			print('%s[!]%s Hook %s%s%s did not run to completion.' % (Fore.RED, Fore.RESET, Fore.GREEN, hook, Fore.RESET))
+
+	for hookpath in written:
+		try:
 			os.unlink(hookpath)
+		except OSError:
+			pass
 
 print('%s[*]%s Finished install.' % (Fore.GREEN, Fore.RESET))
\ No newline at end of file
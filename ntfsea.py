@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 # coding=utf-8
+import os
 import sys
 import struct
-import ctypes
+import threading
 import tarfile
-import platform
 
 
 # class for manipulating mode bits stored in lxattrb
@@ -129,10 +129,26 @@ class stmode:
 		return mode & ~stmode.IFMT
 
 
-# class for parsing and generating lxattrb entries
+# class for parsing and generating lxattrb entries. an instance is created for every entry of
+# the extracted archives, so it has no __dict__, and the structure is compiled only once
 
 class lxattrb:
-	structure = 'HHIIIIIIIQQQ'
+	__slots__ = ('flags', 'version', 'mode', 'uid', 'gid', 'drive', 'atime', 'mtime', 'ctime')
+
+	structure = struct.Struct('HHIIIIIIIQQQ')
+
+	# file type bits for each TarInfo type, in place of the TarInfo.is*() methods
+
+	tartypes = {tarfile.REGTYPE:        stmode.FREG,
+	            tarfile.AREGTYPE:       stmode.FREG,
+	            tarfile.CONTTYPE:       stmode.FREG,
+	            tarfile.GNUTYPE_SPARSE: stmode.FREG,
+	            tarfile.DIRTYPE:        stmode.FDIR,
+	            tarfile.SYMTYPE:        stmode.FLNK,
+	            tarfile.LNKTYPE:        stmode.FLNK,
+	            tarfile.CHRTYPE:        stmode.FCHR,
+	            tarfile.BLKTYPE:        stmode.BLCK,
+	            tarfile.FIFOTYPE:       stmode.FIFO}
 
 	def __init__(self, mode = 0, uid = 0, gid = 0, drive = 0, atime = 0, mtime = 0, ctime = 0):
 		self.flags   = 0
@@ -151,7 +167,7 @@ class lxattrb:
 		:return: Entry bytes.
 		"""
 
-		return struct.pack(lxattrb.structure, self.flags, self.version, self.mode, self.uid, self.gid, self.drive, 0, 0, 0, self.atime, self.mtime, self.ctime)
+		return lxattrb.structure.pack(self.flags, self.version, self.mode, self.uid, self.gid, self.drive, 0, 0, 0, self.atime, self.mtime, self.ctime)
 
 	@staticmethod
 	def parse(value):
@@ -162,7 +178,7 @@ class lxattrb:
 		"""
 
 		ret = lxattrb()
-		ret.flags, ret.version, ret.mode, ret.uid, ret.gid, ret.drive, _, _, _, ret.atime, ret.mtime, ret.ctime = struct.unpack(lxattrb.structure, value)
+		ret.flags, ret.version, ret.mode, ret.uid, ret.gid, ret.drive, _, _, _, ret.atime, ret.mtime, ret.ctime = lxattrb.structure.unpack(value)
 		return ret
 
 	@staticmethod
@@ -173,36 +189,11 @@ class lxattrb:
 		:return: An instance of this class with the data members filled accordingly.
 		"""
 
-		ret = lxattrb()
+		# float 2 int, the modification time is used for all three times
 
-		ret.uid   = tar.uid
-		ret.gid   = tar.gid
-		ret.drive = 0
-		# float 2 int
-		ret.atime = int(getattr(tar.pax_headers, "atime", tar.mtime))
-		ret.mtime = int(tar.mtime)
-		ret.ctime = int(getattr(tar.pax_headers, "ctime", tar.mtime))
-
-		# set file type
-
-		if tar.isfile():
-			ret.mode |= stmode.FREG
-		elif tar.isdir():
-			ret.mode |= stmode.FDIR
-		elif tar.issym() or tar.islnk():
-			ret.mode |= stmode.FLNK
-		elif tar.ischr():
-			ret.mode |= stmode.FCHR
-		elif tar.isblk():
-			ret.mode |= stmode.BLCK
-		elif tar.isfifo():
-			ret.mode |= stmode.FIFO
-
-		# apply permissions
-
-		ret.mode |= tar.mode
+		mtime = int(tar.mtime)
 
-		return ret
+		return lxattrb(lxattrb.tartypes.get(tar.type, 0) | tar.mode, tar.uid, tar.gid, 0, mtime, mtime, mtime)
 
 	@staticmethod
 	def fromsfs(sfs):
@@ -212,56 +203,171 @@ class lxattrb:
 		:return: An instance of this class with the data members filled accordingly.
 		"""
 
-		ret = lxattrb()
+		inode = sfs.inode
 
-		ret.uid   = sfs.inode.uid
-		ret.gid   = sfs.inode.gid
-		ret.drive = 0
-		ret.atime = sfs.inode.time
-		ret.mtime = sfs.inode.time
-		ret.ctime = sfs.inode.time
-		ret.mode  = sfs.inode.mode
+		return lxattrb(inode.mode, inode.uid, inode.gid, 0, inode.time, inode.time, inode.time)
 
-		return ret
 
+# backend for reading and writing the extended attributes on NTFS through ntfsea.dll
+#
+# ctypes is only imported once the backend is initialized, along with the internal structures
+# of the ntfsea.dll, as it is not needed for anything else, and takes a while to import
+
+class ntfsea_dll:
+	name = 'dll'
+
+	def __init__(self):
+		import ctypes
+		import platform
+
+		class ntfsea_Ea(ctypes.Structure):
+			_fields_ = [('Name',        ctypes.c_char * 256),
+			            ('ValueLength', ctypes.c_uint),
+			            ('Value',       ctypes.c_ubyte * 256)]
+
+		class ntfsea_EaList(ctypes.Structure):
+			_fields_ = [('ListSize', ctypes.c_uint),
+			            ('List',     ntfsea_Ea * 4096)]
+
+		if hasattr(ctypes, 'WinDLL'):
+			loader = ctypes.WinDLL
+		else:
+			loader = ctypes.CDLL
+
+		self.lib = loader('ntfsea_%s.dll' % ('x64' if platform.architecture()[0] == '64bit' else 'x86'))
+		self.lib.GetEaList.restype = ctypes.POINTER(ntfsea_EaList)
+		self.lib.GetEa.restype     = ctypes.POINTER(ntfsea_Ea)
+		self.lib.WriteEa.restype   = ctypes.c_int
+
+		# with the argument types declared, ctypes passes str and bytes objects directly,
+		# instead of having to allocate wrapper objects and buffers for each call
 
-# internal structures of the ntfsea.dll for ctypes
+		self.lib.WriteEa.argtypes  = [ctypes.c_wchar_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint]
 
-class ntfsea_Ea(ctypes.Structure):
-	_fields_ = [('Name',        ctypes.c_char * 256),
-	            ('ValueLength', ctypes.c_uint),
-	            ('Value',       ctypes.c_ubyte * 256)]
+		ntfsea.pwstr  = ctypes.c_wchar_p
+		ntfsea.pstr   = lambda str: ctypes.c_char_p(str.encode('utf-8'))
+		ntfsea.pbytes = lambda str: ctypes.create_string_buffer(str, len(str))
 
+	def getattrlist(self, file):
+		ret = self.lib.GetEaList(ntfsea.pwstr(file))
 
-class ntfsea_EaList(ctypes.Structure):
-	_fields_ = [('ListSize', ctypes.c_uint),
-	            ('List',     ntfsea_Ea * 4096)]
+		if ret.contents.ListSize > 0:
+			eas = []
+
+			for i in range(0, ret.contents.ListSize):
+				try:
+					eas += [(ret.contents.List[i].Name.decode('utf-8'),
+					        bytes(ret.contents.List[i].Value[:ret.contents.List[i].ValueLength]))]
+				except Exception:
+					pass
+
+			return eas
+		else:
+			return None
+
+	def getattr(self, file, name):
+		ret = self.lib.GetEa(ntfsea.pwstr(file), ntfsea.pstr(name))
+
+		if 0 < ret.contents.ValueLength <= 256:
+			try:
+				return bytes(ret.contents.Value[:ret.contents.ValueLength])
+			except Exception:
+				return None
+		else:
+			return None
+
+	def writeattr(self, file, name, value):
+		return self.lib.WriteEa(file, name.encode('utf-8'), value, len(value))
+
+	def writeattrs(self, entries):
+		write = self.lib.WriteEa
+		names = {}
+		fails = 0
+
+		for file, name, value in entries:
+			bname = names.get(name)
+
+			if bname is None:
+				bname = names[name] = name.encode('utf-8')
+
+			if write(file, bname, value, len(value)) != len(value):
+				fails += 1
+
+		return fails
+
+
+# backend for storing the extended attributes as user.* xattrs on Linux, so the extraction
+# can be run and benchmarked on a regular Linux file system as a stand-in for NTFS
+
+class ntfsea_xattr:
+	name   = 'xattr'
+	prefix = 'user.'
+
+	def getattrlist(self, file):
+		try:
+			eas = [(name[len(self.prefix):], os.getxattr(file, name)) for name in os.listxattr(file) if name.startswith(self.prefix)]
+		except OSError:
+			return None
+
+		return eas if len(eas) > 0 else None
+
+	def getattr(self, file, name):
+		try:
+			return os.getxattr(file, self.prefix + name)
+		except OSError:
+			return None
+
+	def writeattr(self, file, name, value):
+		try:
+			os.setxattr(file, self.prefix + name, value)
+		except OSError:
+			return -1
+
+		return len(value)
+
+	def writeattrs(self, entries):
+		setxattr = os.setxattr
+		fails    = 0
+
+		for file, name, value in entries:
+			try:
+				setxattr(file, self.prefix + name, value)
+			except OSError:
+				fails += 1
+
+		return fails
 
 
 # class for interfacing with the ntfsea.dll library
 
 class ntfsea:
-	lib    = None
-	pwstr  = ctypes.c_wchar_p
-	pstr   = lambda str: ctypes.c_char_p(str.encode('utf-8'))
-	pbytes = lambda str: ctypes.create_string_buffer(str, len(str))
+	lib     = None
+	backend = None
+	pwstr   = None
+	pstr    = None
+	pbytes  = None
+
+	backends  = {'dll': ntfsea_dll, 'xattr': ntfsea_xattr}
+	batch     = []
+	batchsize = 1024
+	batchfail = 0
+	batchlock = threading.Lock()
+	flushlock = threading.Lock()
 
 	@staticmethod
-	def init():
+	def init(backend = None):
 		"""
 		Initializes the ntfsea library.
+		:param backend: Name of the backend to use, either 'dll' or 'xattr'. When not specified, the NTFSEA_BACKEND
+		                environmental variable is consulted, then 'xattr' is used on Linux and 'dll' everywhere else.
 		"""
 
-		if ntfsea.lib is None:
-			if hasattr(ctypes, 'WinDLL'):
-				loader = ctypes.WinDLL
-			else:
-				loader = ctypes.CDLL
+		if ntfsea.backend is None:
+			if backend is None:
+				backend = os.environ.get('NTFSEA_BACKEND') or ('xattr' if sys.platform.startswith('linux') else 'dll')
 
-			ntfsea.lib = loader('ntfsea_%s.dll' % ('x64' if platform.architecture()[0] == '64bit' else 'x86'))
-			ntfsea.lib.GetEaList.restype = ctypes.POINTER(ntfsea_EaList)
-			ntfsea.lib.GetEa.restype     = ctypes.POINTER(ntfsea_Ea)
-			ntfsea.lib.WriteEa.restype   = ctypes.c_int
+			ntfsea.backend = ntfsea.backends[backend]()
+			ntfsea.lib     = getattr(ntfsea.backend, 'lib', None)
 
 	@staticmethod
 	def getattrlist(file):
@@ -271,21 +377,7 @@ class ntfsea:
 		:return: List of extended attributes or None.
 		"""
 
-		ret = ntfsea.lib.GetEaList(ntfsea.pwstr(file))
-
-		if ret.contents.ListSize > 0:
-			eas = []
-
-			for i in range(0, ret.contents.ListSize):
-				try:
-					eas += [(ret.contents.List[i].Name.decode('utf-8'),
-					        bytes(ret.contents.List[i].Value[:ret.contents.List[i].ValueLength]))]
-				except Exception:
-					pass
-
-			return eas
-		else:
-			return None
+		return ntfsea.backend.getattrlist(file)
 
 	@staticmethod
 	def getattr(file, name):
@@ -296,15 +388,7 @@ class ntfsea:
 		:return: Extended attribute information or None.
 		"""
 
-		ret = ntfsea.lib.GetEa(ntfsea.pwstr(file), ntfsea.pstr(name))
-
-		if 0 < ret.contents.ValueLength <= 256:
-			try:
-				return bytes(ret.contents.Value[:ret.contents.ValueLength])
-			except Exception:
-				return None
-		else:
-			return None
+		return ntfsea.backend.getattr(file, name)
 
 	@staticmethod
 	def writeattr(file, name, value):
@@ -316,5 +400,53 @@ class ntfsea:
 		:return: Number of bytes written (should match EaValueLength) or -1 on failure.
 		"""
 
-		ret = ntfsea.lib.WriteEa(ntfsea.pwstr(file), ntfsea.pstr(name), ntfsea.pbytes(value), len(value))
-		return ret
+		return ntfsea.backend.writeattr(file, name, value)
+
+	@staticmethod
+	def queueattr(file, name, value):
+		"""
+		Queues the specified extended attribute to be written to the requested file with the next batch.
+		The batch is written automatically once it reaches batchsize entries. Safe to call from multiple threads.
+		:param file: Path to the file.
+		:param name: Name of the extended attribute.
+		:param value: Value of the extended attribute.
+		"""
+
+		with ntfsea.batchlock:
+			ntfsea.batch.append((file, name, value))
+
+			if len(ntfsea.batch) < ntfsea.batchsize:
+				return
+
+			batch, ntfsea.batch = ntfsea.batch, []
+
+			# batches are written in the order they were taken, so when the same file is queued
+			# multiple times, the last value is guaranteed to be the one which ends up on disk
+
+			ntfsea.flushlock.acquire()
+
+		try:
+			ntfsea.batchfail += ntfsea.backend.writeattrs(batch)
+		finally:
+			ntfsea.flushlock.release()
+
+	@staticmethod
+	def flushattrs():
+		"""
+		Writes all the queued extended attributes.
+		:return: Number of attributes which failed to be written since the last flush.
+		"""
+
+		with ntfsea.batchlock:
+			batch, ntfsea.batch = ntfsea.batch, []
+			ntfsea.flushlock.acquire()
+
+		try:
+			fails, ntfsea.batchfail = ntfsea.batchfail, 0
+
+			if len(batch) > 0:
+				fails += ntfsea.backend.writeattrs(batch)
+		finally:
+			ntfsea.flushlock.release()
+
+		return fails
@@ -7,12 +7,12 @@
 import platform
 from os import system
 
-files = ['get-source', 'get-prebuilt', 'install', 'switch']
+files = ['get-source', 'get-prebuilt', 'install', 'switch', 'export']
 
 for file in files:
 	binaries = None
 
-	if file == 'install':
+	if file == 'install' or file == 'export':
 		binaries = [('ntfsea_%s.dll' % ('x64' if platform.architecture()[0] == '64bit' else 'x86'), '.')]
 
 	a = Analysis([file + '.py'], pathex=['.'], binaries=binaries, datas=None, hiddenimports=[], hookspath=[], runtime_hooks=[], excludes=[], win_no_prefer_redirects=False, win_private_assemblies=False, cipher=None)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# coding=utf-8
+import threading
+import PySquashfsImage
+
+from collections import OrderedDict
+from PySquashfsImage import PySquashfsImage as sqfs
+
+
+# least recently used cache of decompressed blocks
+
+class BlockCache:
+	"""
+	Keeps the most recently used decompressed blocks in memory, up to a total size.
+	Small files share fragment blocks, which would otherwise be decompressed again for
+	each of them, and identical files share their data blocks.
+	"""
+
+	def __init__(self, budget):
+		"""
+		Initializes the cache.
+
+		:param budget: Maximum total size of the cached blocks in bytes.
+		"""
+
+		self.budget = budget
+		self.size   = 0
+		self.hits   = 0
+		self.misses = 0
+		self.blocks = OrderedDict()
+		self.lock   = threading.Lock()
+
+	def get(self, key, load):
+		"""
+		Gets a block from the cache, or loads and caches it if it is not cached.
+
+		:param key: Key of the block, such as its offset in the image.
+		:param load: Function returning the decompressed block.
+
+		:return: Decompressed block.
+		"""
+
+		with self.lock:
+			block = self.blocks.get(key)
+
+			if block is not None:
+				self.blocks.move_to_end(key)
+				self.hits += 1
+				return block
+
+			self.misses += 1
+
+		block = load()
+
+		if len(block) > self.budget:
+			return block
+
+		with self.lock:
+			if key not in self.blocks:
+				self.blocks[key] = block
+				self.size += len(block)
+
+				while self.size > self.budget:
+					_, evicted = self.blocks.popitem(last = False)
+					self.size -= len(evicted)
+
+		return block
+
+
+# PySquashfsImage decompresses every fragment block of the image when it is opened and keeps
+# them in memory, and returns the contents of a file as a single bytes object, which it builds
+# by repeated concatenation. this extends it to decompress the fragment blocks only when needed,
+# and to return the contents of the files block by block, so the memory usage of the extraction
+# does not depend on the size of the image or of the largest file in it.
+#
+# the data blocks are read through a separate file object on each thread, instead of seeking the
+# shared one, so the contents of multiple files can be decompressed on different threads at once.
+
+class StreamingSquashFsImage(PySquashfsImage.SquashFsImage):
+	def __init__(self, filepath = None, offset = None, cache = None):
+		"""
+		Opens the image.
+
+		:param filepath: Path to the image.
+		:param offset: Offset of the image in the file.
+		:param cache: BlockCache instance to keep the decompressed blocks in, or None.
+		"""
+
+		self.cache = cache
+		self.local = threading.local()
+		self.files = []
+		self.lock  = threading.Lock()
+
+		# furthest offset read from the data blocks, which are laid out in the order they are walked
+
+		self.frontier = 0
+
+		PySquashfsImage.SquashFsImage.__init__(self, filepath, offset)
+
+	def close(self):
+		"""
+		Closes the image.
+		"""
+
+		with self.lock:
+			for file in self.files:
+				file.close()
+
+			self.files = []
+
+		PySquashfsImage.SquashFsImage.close(self)
+
+	def read_data_block(self, myfile, start, size):
+		"""
+		Reads and decompresses a data or fragment block, going through the cache if there is one.
+
+		:param myfile: Image file.
+		:param start: Offset of the block.
+		:param size: Size of the block, with the uncompressed flag.
+
+		:return: Decompressed block.
+		"""
+
+		if self.cache is None:
+			return self.read_block_at(start, size)
+
+		return self.cache.get(start, lambda: self.read_block_at(start, size))
+
+	def read_block_at(self, start, size):
+		"""
+		Reads and decompresses a data or fragment block, using the file object of the current thread.
+
+		:param start: Offset of the block.
+		:param size: Size of the block, with the uncompressed flag.
+
+		:return: Decompressed block.
+		"""
+
+		file = getattr(self.local, 'file', None)
+
+		if file is None:
+			file = self.local.file = open(self.image_file.name, 'rb')
+
+			with self.lock:
+				self.files.append(file)
+
+		file.seek(self.offset + start)
+		data = file.read(sqfs.SQUASHFS_COMPRESSED_SIZE_BLOCK(size))
+
+		self.frontier = max(self.frontier, self.offset + start + len(data))
+
+		if sqfs.SQUASHFS_COMPRESSED_BLOCK(size):
+			return self.comp.uncompress(data)
+
+		return data
+
+	def read_fragment_table(self, myfile):
+		"""
+		Reads the locations of the fragment blocks, without decompressing them.
+
+		:param myfile: Image file.
+		"""
+
+		indexes = sqfs.SQUASHFS_FRAGMENT_INDEXES(self.sBlk.fragments)
+		self.fragment_table = []
+
+		if self.sBlk.fragments == 0:
+			return
+
+		myfile.seek(self.offset + self.sBlk.fragment_table_start)
+		fragment_table_index = [self.readLong(myfile) for i in range(indexes)]
+
+		table = b''.join(self.read_block(myfile, index)[0] for index in fragment_table_index)
+		ofs   = 0
+
+		while ofs < len(table):
+			entry = sqfs._Squashfs_fragment_entry()
+			ofs   = entry.fill(table, ofs)
+			self.fragment_table.append(entry)
+
+	def walk(self):
+		"""
+		Iterates over the entries of the image, in the same order as findAll(),
+		without collecting them into a list first.
+
+		:return: Generator of SquashedFile instances.
+		"""
+
+		stack = [self.root]
+
+		while stack:
+			file = stack.pop()
+			yield file
+			stack.extend(reversed(file.children))
+
+	def iter_content(self, inode):
+		"""
+		Decompresses the contents of a file one block at a time.
+
+		:param inode: Inode of the file.
+
+		:return: Generator of the decompressed blocks.
+		"""
+
+		start = inode.start
+		left  = inode.data
+
+		for size in self.read_block_list(inode):
+
+			# sparse blocks are not stored, they are made up of zeros
+
+			if size == 0:
+				block = bytes(min(self.block_size, left))
+
+			else:
+				block = self.read_data_block(self.image_file, start, size)
+				start += sqfs.SQUASHFS_COMPRESSED_SIZE_BLOCK(size)
+
+			left -= len(block)
+			yield block
+
+		# the tail end of the file is stored in a fragment block, shared with other files
+
+		if inode.frag_bytes != 0:
+			entry = self.fragment_table[inode.fragment]
+			block = self.read_data_block(self.image_file, entry.start_block, entry.size)
+
+			yield block[inode.offset:inode.offset + inode.frag_bytes]
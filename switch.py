@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 # coding=utf-8
-import glob
 import sys
+import stat
+import time
 import os.path
-import subprocess
-from utils import Fore, parse_image_arg, probe_wsl, get_label, path_trans, handle_sigint
+from utils import Fore, parse_image_arg, probe_wsl, get_label, handle_sigint, Manifest, Registry, SwitchError, switch_rootfs, recover_switch
 
 # handle arguments
 
@@ -15,6 +15,7 @@ if len(sys.argv) < 2:
 	# print usage information
 
 	print('usage: ./switch.py image[:tag]')
+	print('       ./switch.py --query image[:tag] [path]')
 
 	# check if there are any installations
 
@@ -23,17 +24,28 @@ if len(sys.argv) < 2:
 	if basedir:
 		#fix basedir to add LocalState\rootfs
 		basedir = os.path.join(basedir, 'LocalState')
-		names = glob.glob(os.path.join(basedir, 'rootfs*'))
 		not_debian = True
 		has_debian = False
 
+		# the labels are only read from the rootfs directories which changed since the last listing
+
+		registry = Registry(basedir)
+
+		if registry.refresh():
+			try:
+				registry.save()
+			except OSError:
+				pass
+
+		names = registry.distributions()
+
 		if len(names) > 0:
 
 			print('\nThe following distributions are currently installed:\n')
 
-			for name in names:
-				active = os.path.basename(name) == 'rootfs'
-				name   = get_label(name).split('_', 1)
+			for dirname, label, details in names:
+				active = dirname == 'rootfs'
+				name   = label.split('_', 1)
 
 				if len(name) != 2:
 					continue
@@ -44,7 +56,12 @@ if len(sys.argv) < 2:
 					if active:
 						not_debian = False
 
-				print('  - %s%s%s:%s%s%s%s' % (Fore.YELLOW, name[0], Fore.RESET, Fore.YELLOW, name[1], Fore.RESET, ('%s*%s' % (Fore.GREEN, Fore.RESET) if active else '')))
+				info = ''
+
+				if details:
+					info = ' (installed %s, %.2f MB in %d entries)' % (time.strftime('%Y-%m-%d %H:%M', time.localtime(details['installed'])), details['size'] / 1024 / 1024, details['entries'])
+
+				print('  - %s%s%s:%s%s%s%s%s' % (Fore.YELLOW, name[0], Fore.RESET, Fore.YELLOW, name[1], Fore.RESET, ('%s*%s' % (Fore.GREEN, Fore.RESET) if active else ''), info))
 
 		if not_debian:
 			print()
@@ -56,6 +73,50 @@ if len(sys.argv) < 2:
 
 	sys.exit(-1)
 
+# list the entries of an installed rootfs from its manifest, without walking the tree
+
+if sys.argv[1].lower() == '--query':
+	if len(sys.argv) < 3:
+		print('usage: ./switch.py --query image[:tag] [path]')
+		sys.exit(-1)
+
+	image, tag, fname, label = parse_image_arg(sys.argv[2], False)
+	prefix = sys.argv[3].strip('/') if len(sys.argv) > 3 else ''
+
+	basedir, lxpath, bashpath = probe_wsl()
+	basedir = os.path.join(basedir, 'LocalState')
+	path    = os.path.join(basedir, 'rootfs')
+
+	if get_label(path) != label:
+		path = os.path.join(basedir, 'rootfs_' + label)
+
+	if not os.path.isdir(path):
+		print('%s[!]%s The %s%s%s:%s%s%s rootfs is not installed.' % (Fore.RED, Fore.RESET, Fore.YELLOW, image, Fore.RESET, Fore.YELLOW, tag, Fore.RESET))
+		sys.exit(-1)
+
+	entries = Manifest.read(path)
+
+	if entries is None:
+		print('%s[!]%s The %s%s%s:%s%s%s rootfs has no %s.switch_manifest%s, reinstall it to create one.' % (Fore.RED, Fore.RESET, Fore.YELLOW, image, Fore.RESET, Fore.YELLOW, tag, Fore.RESET, Fore.BLUE, Fore.RESET))
+		sys.exit(-1)
+
+	found = 0
+
+	for name in sorted(entries):
+		if prefix and name != prefix and not name.startswith(prefix + '/'):
+			continue
+
+		entry  = entries[name]
+		found += 1
+
+		print('%s%s %5d %5d %10d %s %s/%s%s' % (entry.type, stat.filemode(entry.mode)[1:], entry.uid, entry.gid, entry.size, time.strftime('%Y-%m-%d %H:%M', time.localtime(entry.mtime)), entry.sha256 + '  ' if entry.sha256 else '', name, '/' if entry.type == 'd' and name else ''))
+
+	if not found:
+		print('%s[!]%s No entries found at %s/%s%s.' % (Fore.YELLOW, Fore.RESET, Fore.BLUE, prefix, Fore.RESET))
+		sys.exit(-1)
+
+	sys.exit(0)
+
 image, tag, fname, label = parse_image_arg(sys.argv[1], False)
 
 # sanity checks
@@ -66,6 +127,18 @@ basedir, lxpath, bashpath = probe_wsl()
 #fix basedir to add LocalState\rootfs
 basedir = os.path.join(basedir, 'LocalState')
 
+# finish a switch which was interrupted by the previous run
+
+try:
+	recovered = recover_switch(basedir)
+
+	if recovered is not None:
+		print('%s[!]%s The previous switch was interrupted, and has been %s.' % (Fore.YELLOW, Fore.RESET, recovered))
+
+except OSError as err:
+	print('%s[!]%s Failed to recover the previous interrupted switch: %s' % (Fore.RED, Fore.RESET, err))
+	sys.exit(-1)
+
 # read label of current distribution
 
 clabel = get_label(os.path.join(basedir, 'rootfs'))
@@ -92,29 +165,34 @@ if not os.path.isdir(os.path.join(basedir, 'rootfs_' + label)):
 
 # do the switch
 
-print('%s[*]%s Moving current %srootfs%s to %srootfs_%s%s...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, Fore.RESET, Fore.BLUE, clabel, Fore.RESET))
+print('%s[*]%s Moving current %srootfs%s to %srootfs_%s%s and desired %srootfs_%s%s to %srootfs%s...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, Fore.RESET, Fore.BLUE, clabel, Fore.RESET, Fore.BLUE, label, Fore.RESET, Fore.BLUE, Fore.RESET))
 
 try:
-	subprocess.check_output(['cmd', '/C', 'move', path_trans(os.path.join(basedir, 'rootfs')), path_trans(os.path.join(basedir, 'rootfs_' + clabel))])
+	switch_rootfs(basedir, 'rootfs_' + clabel, os.path.join(basedir, 'rootfs_' + label))
 
-except subprocess.CalledProcessError as err:
-	print('%s[!]%s Failed to backup current %srootfs%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET, err))
-	sys.exit(-1)
+except SwitchError as err:
+	if err.step == 'backup':
+		print('%s[!]%s Failed to backup current %srootfs%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET, err))
 
-print('%s[*]%s Moving desired %srootfs_%s%s to %srootfs%s...' % (Fore.GREEN, Fore.RESET, Fore.BLUE, label, Fore.RESET, Fore.BLUE, Fore.RESET))
+	elif err.step == 'switch':
+		print('%s[!]%s Failed to switch to new %srootfs%s, rolled back to old %srootfs%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET, Fore.BLUE, Fore.RESET, err))
 
-try:
-	subprocess.check_output(['cmd', '/C', 'move', path_trans(os.path.join(basedir, 'rootfs_' + label)), path_trans(os.path.join(basedir, 'rootfs'))])
+	else:
+		print('%s[!]%s Failed to switch to new %srootfs%s, and to roll back to old %srootfs%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET, Fore.BLUE, Fore.RESET, err))
+		print('%s[!]%s You are now the proud owner of one broken Linux subsystem! To fix it, run %slxrun /uninstall%s and %slxrun /install%s from the command prompt.' % (Fore.RED, Fore.RESET, Fore.GREEN, Fore.RESET, Fore.GREEN, Fore.RESET))
+
+	sys.exit(-1)
 
-except subprocess.CalledProcessError as err:
-	print('%s[!]%s Failed to switch to new %srootfs%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET, err))
-	print('%s[*]%s Rolling back to old %srootfs%s...' % (Fore.YELLOW, Fore.RESET, Fore.BLUE, Fore.RESET))
+except OSError as err:
+	print('%s[!]%s Failed to write the switch journal: %s' % (Fore.RED, Fore.RESET, err))
+	sys.exit(-1)
 
-	try:
-		subprocess.check_output(['cmd', '/C', 'move', path_trans(os.path.join(basedir, 'rootfs_' + clabel)), path_trans(os.path.join(basedir, 'rootfs'))])
+# relabel the renamed directories in the registry
 
-	except subprocess.CalledProcessError as err:
-		print('%s[!]%s Failed to roll back to old %srootfs%s: %s' % (Fore.RED, Fore.RESET, Fore.BLUE, Fore.RESET, err))
-		print('%s[!]%s You are now the proud owner of one broken Linux subsystem! To fix it, run %slxrun /uninstall%s and %slxrun /install%s from the command prompt.' % (Fore.RED, Fore.RESET, Fore.GREEN, Fore.RESET, Fore.GREEN, Fore.RESET))
+try:
+	registry = Registry(basedir)
+	registry.refresh()
+	registry.save()
 
-	sys.exit(-1)
+except OSError as err:
+	print('%s[!]%s Failed to update the registry of the installed distributions: %s' % (Fore.YELLOW, Fore.RESET, err))
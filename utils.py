@@ -2,26 +2,33 @@
 # coding=utf-8
 import io
 import os
+import mmap
 import re
 import sys
-import ssl
+import stat
 import glob
 import time
-import shlex
+import json
+import errno
+import posixpath
+import collections
 import signal
-import subprocess
+import threading
+
+# the networking, hashing and process modules take a while to import, and not every script needs
+# them, switch.py in particular, so they are imported where they are first used instead
 
 
 has_filter   = False
 has_progress = False
 has_winreg   = False
-has_certifi  = False
 
 is_cygwin = sys.platform == 'cygwin'
 is_win32  = sys.platform == 'win32'
 is_conemu = False
 
 last_progress = 0
+progress_lock = threading.RLock()
 
 
 # try importing the optional dependencies
@@ -32,12 +39,6 @@ try:
 except ImportError:
 	pass
 
-try:
-	import certifi
-	has_certifi = True
-except ImportError:
-	pass
-
 if is_win32:
 	try:
 		from colorama import init
@@ -46,11 +47,6 @@ if is_win32:
 	except ImportError:
 		pass
 
-	import ctypes
-
-	class ConsoleCursorInfo(ctypes.Structure):
-		_fields_ = [("size", ctypes.c_int), ("visible", ctypes.c_byte)]
-
 if not is_win32 or has_filter:
 	class Fore:
 		RED    = '\x1B[91m'
@@ -82,8 +78,15 @@ def handle_sigint():
 # check if any CA bundles were loaded or fallback to certifi otherwise
 
 def ensure_ca_load():
+	import ssl
+
 	if ssl.create_default_context().cert_store_stats()['x509_ca'] == 0:
-		if has_certifi:
+		try:
+			import certifi
+		except ImportError:
+			certifi = None
+
+		if certifi is not None:
 			def create_certifi_context(purpose = ssl.Purpose.SERVER_AUTH, *, cafile = None, capath = None, cadata = None):
 				return ssl.create_default_context(purpose, cafile = certifi.where())
 
@@ -188,6 +191,7 @@ def probe_wsl(silent = False):
 	else:
 		print('JPST: not yet fixed when running this process via cygwin, sorry!')
 		sys.exit(-1)
+		import subprocess
 		basedir = subprocess.check_output('/usr/bin/cygpath -F 0x001c', shell = True, universal_newlines = True)
 		basedir = os.path.join(basedir.strip(), 'lxss')
 
@@ -209,6 +213,7 @@ def probe_wsl(silent = False):
 	if not is_cygwin:
 		syspath = os.getenv('SystemRoot')
 	else:
+		import subprocess
 		syspath = subprocess.check_output('/usr/bin/cygpath -W', shell = True, universal_newlines = True).strip()
 
 	lxpath  = ''
@@ -372,6 +377,355 @@ def get_label(path):
 	return ''
 
 
+# switch between the installed rootfs directories
+#
+# switching is done with two directory renames: the current rootfs is moved to its backup name, then
+# the new one is moved in its place. the renames are recorded in a journal beforehand, so if the
+# process is interrupted in between, the next run finds no rootfs and can finish or undo the switch.
+#
+# right after WSL exits, its processes may still be holding files within the rootfs open for a
+# short while, during which the rename is denied, so the renames are retried with a backoff.
+
+class SwitchError(OSError):
+	"""
+	Raised when switching the rootfs fails, with the step which failed in step: 'backup' if the
+	current rootfs could not be moved away, 'switch' if the new one could not be moved in its place
+	but the old one was restored, and 'rollback' if the old one could not be restored either.
+	"""
+
+	def __init__(self, step, err):
+		OSError.__init__(self, err.errno, err.strerror, err.filename)
+		self.step = step
+
+
+def rename_retry(src, dst, retries = 8, delay = 0.05):
+	"""
+	Renames a file or directory, retrying with an exponential backoff while access is denied.
+
+	:param src: Path to rename.
+	:param dst: New path, which must not exist.
+	:param retries: Number of retries before giving up.
+	:param delay: Delay before the first retry in seconds, doubled after each retry.
+	"""
+
+	if os.path.exists(dst):
+		raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+
+	for attempt in range(retries + 1):
+		try:
+			os.rename(src, dst)
+			return
+
+		except PermissionError:
+			if attempt == retries:
+				raise
+
+			time.sleep(delay * (2 ** attempt))
+
+
+def switch_rootfs(basedir, backup, source, forward = True):
+	"""
+	Moves the current rootfs to its backup name, and the specified one in its place.
+	If the second rename fails, the first one is reverted.
+
+	:param basedir: Path to the directory containing the rootfs.
+	:param backup: Name to move the current rootfs to, such as rootfs_debian_9.
+	:param source: Path to the rootfs to switch to.
+	:param forward: Whether an interrupted switch should be finished on the next run, or reverted.
+	"""
+
+	rootfs  = os.path.join(basedir, 'rootfs')
+	backup  = os.path.join(basedir, backup)
+	journal = os.path.join(basedir, '.switch_journal')
+
+	with open(journal + '.new', 'w') as f:
+		json.dump({'rootfs': rootfs, 'backup': backup, 'source': source, 'forward': forward}, f)
+
+	os.replace(journal + '.new', journal)
+
+	try:
+		rename_retry(rootfs, backup)
+
+	except OSError as err:
+		os.remove(journal)
+		raise SwitchError('backup', err)
+
+	try:
+		rename_retry(source, rootfs)
+
+	except OSError as err:
+		try:
+			rename_retry(backup, rootfs)
+
+		except OSError:
+			raise SwitchError('rollback', err)
+
+		os.remove(journal)
+		raise SwitchError('switch', err)
+
+	os.remove(journal)
+
+
+def recover_switch(basedir):
+	"""
+	Finishes or reverts a switch which was interrupted between the two renames, as recorded in the journal.
+
+	:param basedir: Path to the directory containing the rootfs.
+
+	:return: 'finished' or 'reverted' if a switch was recovered, otherwise None.
+	"""
+
+	journal = os.path.join(basedir, '.switch_journal')
+
+	try:
+		with open(journal) as f:
+			state = json.load(f)
+
+	except (OSError, ValueError):
+		return None
+
+	result = None
+
+	# the current rootfs was only moved away if it is missing, otherwise the switch either
+	# has not started yet, or has completed
+
+	if not os.path.exists(state['rootfs']):
+		if state['forward'] and os.path.isdir(state['source']):
+			rename_retry(state['source'], state['rootfs'])
+			result = 'finished'
+
+		elif os.path.isdir(state['backup']):
+			rename_retry(state['backup'], state['rootfs'])
+			result = 'reverted'
+
+	os.remove(journal)
+	return result
+
+
+# registry of the installed distributions
+#
+# listing the installed distributions would otherwise need the label of every rootfs, which may
+# involve parsing the release files within them. the registry stored as .switch_registry in the
+# directory of the rootfs keeps the label of each rootfs directory along with its mtime, which
+# changes when .switch_label is written, and the mtime of the containing directory, which changes
+# when a rootfs is added, removed or renamed. as long as that did not change, listing only takes
+# a single stat call. the details of the installations are kept by label, so they survive switching.
+
+class Registry:
+	"""
+	Keeps track of the installed distributions, and the details of their installation.
+	"""
+
+	name = '.switch_registry'
+
+	def __init__(self, basedir):
+		"""
+		Loads the registry, or starts an empty one if it does not exist or is not readable.
+
+		:param basedir: Path to the directory containing the rootfs.
+		"""
+
+		self.basedir = basedir
+		self.path    = os.path.join(basedir, Registry.name)
+
+		try:
+			with open(self.path) as f:
+				self.data = json.load(f)
+
+		except (OSError, ValueError):
+			self.data = {}
+
+		if not isinstance(self.data, dict) or self.data.get('version') != 1:
+			self.data = {'version': 1, 'mtime': 0, 'dirs': {}, 'labels': {}}
+
+	def refresh(self):
+		"""
+		Labels the rootfs directories again if the containing directory changed since the last time.
+		Only the directories which changed themselves are labelled through get_label().
+
+		:return: Whether the directories were scanned.
+		"""
+
+		try:
+			mtime = os.stat(self.basedir).st_mtime_ns
+
+		except OSError:
+			return False
+
+		if mtime == self.data['mtime']:
+			return False
+
+		dirs = {}
+
+		for path in glob.glob(os.path.join(self.basedir, 'rootfs*')):
+			name = os.path.basename(path)
+
+			if name == 'rootfs-temp' or not os.path.isdir(path):
+				continue
+
+			try:
+				dmtime = os.stat(path).st_mtime_ns
+				known  = self.data['dirs'].get(name)
+
+				if known is not None and known['mtime'] == dmtime:
+					label = known['label']
+
+				else:
+					# get_label() may write the .switch_label file
+
+					label  = get_label(path)
+					dmtime = os.stat(path).st_mtime_ns
+
+			except OSError:
+				continue
+
+			dirs[name] = {'label': label, 'mtime': dmtime}
+
+		self.data['dirs']  = dirs
+		self.data['mtime'] = mtime
+		return True
+
+	def record(self, label, **details):
+		"""
+		Records the details of an installation, such as its time, or the digest of the archive.
+
+		:param label: Label of the installed rootfs.
+		:param details: Details to store.
+		"""
+
+		self.data['labels'][label] = details
+
+	def distributions(self):
+		"""
+		Lists the installed distributions.
+
+		:return: List of the directory name, label and recorded details of each rootfs, ordered by name.
+		"""
+
+		return [(name, entry['label'], self.data['labels'].get(entry['label'], {})) for name, entry in sorted(self.data['dirs'].items())]
+
+	def save(self):
+		"""
+		Writes the registry. The file is overwritten in place, as creating or renaming it would
+		change the mtime of the containing directory, and the next refresh would scan it again.
+		"""
+
+		if not os.path.exists(self.path):
+			mtime = os.stat(self.basedir).st_mtime_ns
+
+			with open(self.path, 'w'):
+				pass
+
+			if self.data['mtime'] == mtime:
+				self.data['mtime'] = os.stat(self.basedir).st_mtime_ns
+
+		with open(self.path, 'r+') as f:
+			json.dump(self.data, f)
+			f.truncate()
+
+
+class TrailingDigest:
+	"""
+	Calculates the digest of a file on a background thread, trailing right behind the position
+	another reader has reached in it, so the hashed pages are still in the cache of the file system,
+	and the file is only read from the disk once, instead of twice for the reader and the digest.
+	"""
+
+	def __init__(self, path, algorithm = 'sha256', interval = 0.05):
+		"""
+		Maps the file and starts hashing it as the followed reader advances.
+
+		:param path: Path to the file.
+		:param algorithm: Name of the hash algorithm.
+		:param interval: Time between samples of the position of the reader in seconds.
+		"""
+
+		import hashlib
+
+		self.algorithm = algorithm
+		self.hash      = hashlib.new(algorithm)
+		self.interval  = interval
+		self.offset    = 0
+		self.sample    = None
+		self.finished  = threading.Event()
+		self.file      = open(path, 'rb')
+		self.size      = os.fstat(self.file.fileno()).st_size
+
+		# empty files can not be mapped, but then there is nothing to hash either
+
+		try:
+			self.map  = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ) if self.size > 0 else None
+			self.view = memoryview(self.map) if self.map is not None else memoryview(b'')
+		except Exception:
+			self.file.close()
+			raise
+
+		self.thread = threading.Thread(target = self.run, daemon = True)
+		self.thread.start()
+
+	def follow(self, sample):
+		"""
+		Sets the reader to trail behind.
+
+		:param sample: Function returning the offset up to which the reader has read the file. It is
+		               called from the background thread, and errors it raises, such as on reading
+		               the position of a closed file, are taken as the reader not advancing.
+		"""
+
+		self.sample = sample
+
+	def run(self):
+		while True:
+			finished = self.finished.is_set()
+			target   = self.size if finished else self.position()
+
+			while self.offset < target:
+				end = min(target, self.offset + copy_max_chunk)
+				self.hash.update(self.view[self.offset:end])
+				self.offset = end
+
+			if finished:
+				break
+
+			self.finished.wait(self.interval)
+
+	def position(self):
+		"""
+		Samples the position of the followed reader.
+
+		:return: Offset up to which the file can be hashed.
+		"""
+
+		if self.sample is None:
+			return self.offset
+
+		try:
+			return min(self.size, max(self.offset, int(self.sample())))
+		except (OSError, ValueError):
+			return self.offset
+
+	def result(self):
+		"""
+		Hashes the rest of the file, which the reader did not get to, and releases the file.
+
+		:return: Digest in the algorithm:hex format used by the registries.
+		"""
+
+		if self.thread is not None:
+			self.finished.set()
+			self.thread.join()
+			self.thread = None
+
+			self.view.release()
+
+			if self.map is not None:
+				self.map.close()
+
+			self.file.close()
+
+		return '%s:%s' % (self.algorithm, self.hash.hexdigest())
+
+
 # toggle cursor visibility in the terminal
 
 def show_cursor():
@@ -383,11 +737,7 @@ def show_cursor():
 		sys.stdout.write('\033[?25h')
 
 	else:
-		ci = ConsoleCursorInfo()
-		handle = ctypes.windll.kernel32.GetStdHandle(-11)
-		ctypes.windll.kernel32.GetConsoleCursorInfo(handle, ctypes.byref(ci))
-		ci.visible = True
-		ctypes.windll.kernel32.SetConsoleCursorInfo(handle, ctypes.byref(ci))
+		set_console_cursor(True)
 
 
 def hide_cursor():
@@ -402,18 +752,39 @@ def hide_cursor():
 		is_conemu = False
 
 	else:
-		ci = ConsoleCursorInfo()
-		handle = ctypes.windll.kernel32.GetStdHandle(-11)
-		ctypes.windll.kernel32.GetConsoleCursorInfo(handle, ctypes.byref(ci))
-		ci.visible = False
-		ctypes.windll.kernel32.SetConsoleCursorInfo(handle, ctypes.byref(ci))
+		set_console_cursor(False)
 		is_conemu = os.environ.get('ConEmuANSI') == 'ON'
 
 
+def set_console_cursor(visible):
+	"""
+	Turns the cursor on or off in the Windows console, through ctypes, which is only imported here.
+
+	:param visible: Whether the cursor should be visible.
+	"""
+
+	import ctypes
+
+	class ConsoleCursorInfo(ctypes.Structure):
+		_fields_ = [("size", ctypes.c_int), ("visible", ctypes.c_byte)]
+
+	ci = ConsoleCursorInfo()
+	handle = ctypes.windll.kernel32.GetStdHandle(-11)
+	ctypes.windll.kernel32.GetConsoleCursorInfo(handle, ctypes.byref(ci))
+	ci.visible = visible
+	ctypes.windll.kernel32.SetConsoleCursorInfo(handle, ctypes.byref(ci))
+
+
 # some characters are forbidden in NTFS, but are not in ext4. the most popular of these characters
 # seems to be the colon character. LXSS solves this issue by escaping the character on NTFS.
 # while this seems like a dumb implementation, it will be called a lot of times inside the
 # decompression loop, so it has to be fast: http://stackoverflow.com/a/27086669/156626
+#
+# almost no paths contain any of these characters, so they are looked for first with the `in`
+# operator, which scans the string without any allocations, and only the paths which do contain
+# some are escaped, in a single pass with a translation table.
+
+ntfs_invalid_table = str.maketrans({'*': '#002A', '|': '#007C', ':': '#003A', '>': '#003E', '<': '#003C', '?': '#003F', '"': '#0022'})
 
 def escape_ntfs_invalid(name):
 	"""
@@ -423,175 +794,1564 @@ def escape_ntfs_invalid(name):
 
 	:return: Path with forbidden NTFS characters escaped.
 	"""
-	return name.replace('*', '#002A').replace('|', '#007C').replace(':', '#003A').replace('>', '#003E').replace('<', '#003C').replace('?', '#003F').replace('"', '#0022')
+	if ':' not in name and '*' not in name and '|' not in name and '>' not in name and '<' not in name and '?' not in name and '"' not in name:
+		return name
+
+	return name.translate(ntfs_invalid_table)
 
 
 # stream copier with progress bar
 
-def chunked_copy(name, source, dest):
+copy_min_chunk = 64 * 1024
+copy_max_chunk = 4 * 1024 * 1024
+copy_buffer    = threading.local()
+
+def chunked_copy(name, source, dest, progress = True, offset = 0):
 	"""
 	Copies one stream into another, with progress bar.
 
+	The data is read into a preallocated buffer, and the size of the reads starts small and
+	doubles each time the source fills the whole read quickly, so fast sources are copied
+	in a few large reads, while slow connections still update the progress bar frequently.
+
 	:param name: Name of the file to display.
 	:param source: Source stream.
 	:param dest: Destination stream.
+	:param progress: Whether to display the progress bar.
+	:param offset: Number of bytes already downloaded in a previous attempt, for the progress bar.
 
 	:return: Number of bytes copied.
 	"""
 
-	global is_conemu
+	recv     = 0
+	chunk    = copy_min_chunk
+	reporter = None
 
-	size = int(source.info()['Content-Length'].strip())
-	recv = 0
+	# each thread reuses its own buffer, as multiple downloads may run at the same time
 
-	if len(name) > 23:
-		name = name[0:20] + '...'
+	view = getattr(copy_buffer, 'view', None)
 
-	hide_cursor()
+	if view is None:
+		view = copy_buffer.view = memoryview(bytearray(copy_max_chunk))
 
-	while True:
-		chunk = source.read(8192)
-		recv += len(chunk)
+	readinto = getattr(source, 'readinto', None)
 
-		if not chunk:
-			break
+	if progress:
+		reporter = ProgressReporter(int(source.info()['Content-Length'].strip()) + offset, name, offset).start()
 
-		dest.write(chunk)
+	try:
+		while True:
+			then = time.monotonic()
 
-		draw_progress(recv, size, name)
+			if readinto is not None:
+				read = readinto(view[:chunk])
+			else:
+				data = source.read(chunk)
+				read = len(data)
+				view[:read] = data
 
-	show_cursor()
+			if not read:
+				break
+
+			dest.write(view[:read])
+			recv += read
+
+			now = time.monotonic()
+
+			if read == chunk and chunk < copy_max_chunk and now - then < 0.05:
+				chunk *= 2
+
+			if reporter is not None:
+				reporter.recv += read
+
+	finally:
+		if reporter is not None:
+			reporter.stop()
+
+	# reading a response which was cut off by the server returns less data instead of failing
+
+	if getattr(source, 'length', None):
+		import http.client
+		raise http.client.IncompleteRead(b'', source.length)
 
 	return recv
 
 
-# FileIO wrapper with progress bar
+def format_throughput(recv, elapsed):
+	"""
+	Formats the throughput of a transfer for display.
 
-class ProgressFileObject(io.FileIO):
-	def __init__(self, path, *args, **kwargs):
-		self._total_size = os.path.getsize(path)
-		self.current_extraction = ''
-		io.FileIO.__init__(self, path, *args, **kwargs)
+	:param recv: Number of bytes transferred.
+	:param elapsed: Time the transfer took in seconds.
 
-		hide_cursor()
+	:return: Amount, time and speed of the transfer.
+	"""
 
-	def read(self, length):
-		"""
-		Read at most size bytes, returned as bytes.
+	return '%0.2f MB in %0.1f seconds, at %0.2f MB/s' % (recv / 1024 / 1024, elapsed, recv / 1024 / 1024 / max(elapsed, 0.001))
 
-		Only makes one system call, so less data may be returned than requested.
-		In non-blocking mode, returns None if no data is available.
-		Return an empty bytes object at EOF.
-		"""
 
-		draw_progress(self.tell(), self._total_size, self.current_extraction)
+# check whether a server honoured the range requested for resuming a download
+
+def check_range(source, offset):
+	"""
+	Checks the response to a request resuming a download at the specified offset.
 
-		return io.FileIO.read(self, length)
+	:param source: HTTP response.
+	:param offset: Offset requested with the Range header, or 0 if none was sent.
 
-	def __del__(self):
-		show_cursor()
+	:return: Offset at which the response body starts, which is 0 if the server ignored the range.
+	"""
 
+	if not offset or source.status != 206:
+		return 0
 
-# standalone function to draw an interactive progressbar
+	crange = source.getheader('Content-Range') or ''
+	match  = re.match(r'^bytes (\d+)-\d+/(\d+|\*)$', crange.strip())
+
+	if not match or int(match.group(1)) != offset:
+		raise ValueError('server returned range "%s" instead of bytes %d-' % (crange, offset))
+
+	return offset
+
+
+# copy a download into a stream, resuming it with range requests when the connection drops
 
-def draw_progress(recv, size, name):
+def resumable_copy(name, opener, dest, offset = 0, progress = True, source = None, retries = 5):
 	"""
-	Draws an interactive progressbar based on the specified information.
+	Copies a download into a stream with chunked_copy, and if the connection drops, requests
+	the rest of the file from the server and continues from where it left off.
 
-	:param recv: Number of bytes received.
-	:param size: Total size of the file.
 	:param name: Name of the file to display.
+	:param opener: Function opening the download, receiving the offset to request as the start of the range.
+	:param dest: Destination stream, already containing offset bytes.
+	:param offset: Number of bytes already downloaded in a previous attempt.
+	:param progress: Whether to display the progress bar.
+	:param source: Response to use for the first attempt, instead of calling the opener.
+	:param retries: Maximum number of consecutive attempts to resume the download.
+
+	:return: Total size of the download, including the offset.
 	"""
 
-	global is_conemu, has_progress, last_progress
+	import http.client
+	import urllib.error
 
-	if recv > size:
-		recv = size
+	failures = 0
 
-	if recv == size:
-		clear_progress()
-		return
+	while True:
+		out = TeeFileObject(dest)
 
-	if time.time() - last_progress < 0.05:
-		return
+		try:
+			with source or opener(offset) as u:
+				source = None
 
-	has_progress  = True
-	last_progress = time.time()
+				# if the server ignored the range and sent the whole file,
+				# discard the part which was already downloaded
 
-	if len(name) > 23:
-		name = name[0:20] + '...'
-	else:
-		name = name.ljust(23, ' ')
+				skip = offset - check_range(u, offset)
 
-	pct = round(recv / size * 100, 2)
-	bar = int(50 * recv / size)
-	sys.stdout.write('\r    %s [%s>%s] %0.2f%%' % (name, '=' * bar, ' ' * (50 - bar), pct))
+				while skip > 0:
+					chunk = u.read(min(skip, 1024 * 1024))
 
-	if is_conemu:
-		sys.stdout.write('\033]9;4;1;%0.0f\033\\\033[39m' % pct)
+					if not chunk:
+						raise http.client.IncompleteRead(b'', skip)
 
-	sys.stdout.flush()
+					skip -= len(chunk)
 
+				chunked_copy(name, u, out, progress, offset)
 
-def clear_progress():
-	"""
-	Clears the progress bar.
-	"""
+			return offset + out.written
 
-	global is_conemu, has_progress
+		except urllib.error.HTTPError:
+			raise
 
-	if not has_progress:
-		return
+		except (http.client.HTTPException, urllib.error.URLError, ConnectionError, TimeoutError) as err:
+			source   = None
+			offset  += out.written
+			failures = 0 if out.written else failures + 1
+
+			if failures >= retries:
+				raise
+
+			# other downloads may be drawing an aggregate progress bar on another thread
+
+			with progress_lock:
+				clear_progress()
+				print('%s[!]%s Connection lost while downloading %s%s%s, resuming at %0.2f MB: %s' % (Fore.YELLOW, Fore.RESET, Fore.BLUE, name, Fore.RESET, offset / 1024 / 1024, err))
+
+			time.sleep(min(2 ** failures, 30))
+
+
+# writer duplicating the written data into multiple streams
 
-	has_progress = False
+class TeeFileObject:
+	def __init__(self, *files):
+		self.files   = [file for file in files if file is not None]
+		self.written = 0
 
-	sys.stdout.write('\r%s\r' % (' ' * (66 + 23)))
+	def write(self, data):
+		"""
+		Writes the data to all the streams.
+
+		:param data: Data to write.
+		"""
 
-	if is_conemu:
-		sys.stdout.write('\033]9;4;0\033\\\033[39m')
+		for file in self.files:
+			file.write(data)
 
-	sys.stdout.flush()
+		self.written += len(data)
 
 
-# functions to interact with the registry
+# open a decompressor over a non-seekable stream
 
-def get_lxss_user():
+def open_compressed_stream(stream):
 	"""
-	Gets the active user inside WSL.
+	Opens a file object decompressing the specified non-seekable stream, based on its magic bytes.
+	Unlike the streaming mode of tarfile, this supports gzip files with multiple members, such as
+	the concatenated layers written by get-prebuilt.py.
+
+	:param stream: Source stream.
 
-	:return: Tuple of UID, GID and the name of the user.
+	:return: File object returning the decompressed data, or the stream itself if not compressed.
 	"""
-	
-	#gets
-	user = subprocess.check_output(['cmd', '/c', 'debian.exe run whoami'], universal_newlines = True).strip()
-	default_user_output = subprocess.check_output(['cmd', '/c', 'debian.exe run id'], universal_newlines = True).strip()
-	
-	#splits
-	default_user_output = default_user_output.split(' ')
-	uidoutput = default_user_output[0]
-	gidoutput = default_user_output[1]
-	groupsoutput = default_user_output[2]
-	
-	#uid
-	uidoutput = uidoutput.split('=')
-	uidoutput = uidoutput[1]
-	uid = uidoutput.replace('('+user+')','')
-	
-	#gid
-	gidoutput = gidoutput.split('=')
-	gidoutput = gidoutput[1]
-	gid = gidoutput.replace('('+user+')','')
-	
-	return uid, gid, user
 
+	stream = io.BufferedReader(stream, 1024 * 1024)
+	magic  = stream.peek(6)[:6]
 
-def set_default_user(user):
+	if magic.startswith(b'\x1f\x8b'):
+		import gzip
+		return gzip.GzipFile(fileobj = stream, mode = 'rb')
+
+	elif magic.startswith(b'BZh'):
+		import bz2
+		return bz2.BZ2File(stream)
+
+	elif magic.startswith(b'\xfd7zXZ\x00'):
+		import lzma
+		return lzma.LZMAFile(stream)
+
+	return stream
+
+
+# start install.py in a new process, reading the archive from its standard input
+
+def spawn_install(imgarg, size = 0, args = None):
 	"""
-	Switches the active user inside WSL to the requested one.
+	Starts the installer in a new process, which will extract the archive piped into its
+	standard input in streaming mode, instead of reading it from a file.
 
-	:param user: Name of the new user.
+	:param imgarg: Image[:tag] argument to pass, used for labeling the rootfs and for the hooks.
+	:param size: Size of the archive, if known, for the progress bar.
+	:param args: Additional arguments to pass.
+
+	:return: Popen instance whose stdin the archive is to be written into.
 	"""
 
+	if getattr(sys, 'frozen', False):
+		cmd = [os.path.join(os.path.dirname(sys.executable), 'install.exe')]
+	else:
+		cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'install.py')]
+
+	cmd += ['--stdin']
+
+	if size > 0:
+		cmd += ['--size=%d' % size]
+
+	import subprocess
+	return subprocess.Popen(cmd + (args or []) + [imgarg], stdin = subprocess.PIPE)
+
+
+# the archives end at the boundary of a gzip member or a tar entry often enough that the installer
+# can not tell a truncated archive from a complete one, so when the archive could not be piped into
+# it completely, it is killed before its standard input is closed, and it sees the end of the input
+
+def abort_install(proc):
+	"""
+	Stops the installer started by spawn_install(), when piping the archive into it failed.
+
+	:param proc: Popen instance returned by spawn_install().
+	"""
+
+	proc.kill()
+	proc.wait()
+
+	try:
+		proc.stdin.close()
+	except OSError:
+		pass
+
+	# the installer may have been killed while its progress bar was hiding the cursor
+
+	show_cursor()
+
+
+# content-addressed cache for the downloaded layers
+
+class BlobCache:
+	"""
+	Stores downloaded blobs in a directory, keyed by their digest, so layers shared between
+	images or tags are only downloaded once. The total size of the cache is kept under budget
+	by evicting the least recently used blobs, as tracked by their modification time.
+	"""
+
+	def __init__(self, path, budget):
+		"""
+		Opens the cache, creating the directory if it does not exist yet.
+
+		:param path: Path to the cache directory.
+		:param budget: Maximum total size of the cached blobs in bytes.
+		"""
+
+		self.path   = path
+		self.budget = budget
+
+		os.makedirs(self.path, exist_ok = True)
+
+	def blob_path(self, digest):
+		"""
+		Gets the path at which the specified blob would be stored.
+
+		:param digest: Digest of the blob, in algorithm:hex format.
+
+		:return: Path to the blob.
+		"""
+
+		algo, _, value = digest.partition(':')
+
+		if not value or not re.match(r'^[a-z0-9]+$', algo) or not re.match(r'^[a-f0-9]+$', value):
+			raise ValueError('invalid digest %s' % digest)
+
+		return os.path.join(self.path, algo + '_' + value)
+
+	def get(self, digest):
+		"""
+		Looks up a blob and marks it as recently used.
+
+		:param digest: Digest of the blob, in algorithm:hex format.
+
+		:return: Path to the cached blob or None if not cached.
+		"""
+
+		path = self.blob_path(digest)
+
+		try:
+			os.utime(path)
+		except OSError:
+			return None
+
+		return path
+
+	def open(self, digest):
+		"""
+		Opens a writer for a new blob, which is only added to the cache when its
+		contents match the digest. If a previous download of the blob was interrupted,
+		the writer continues it, and its offset is the size of the partial download.
+
+		:param digest: Digest of the blob, in algorithm:hex format.
+
+		:return: BlobWriter instance, to be used as a context manager.
+		"""
+
+		return BlobWriter(self, digest)
+
+	def evict(self, keep = None):
+		"""
+		Removes the least recently used blobs until the cache fits into the budget.
+
+		:param keep: Collection of digests not to remove, such as the ones in use.
+		"""
+
+		keep  = set(self.blob_path(digest) for digest in (keep or []))
+		blobs = []
+		total = 0
+
+		for entry in os.scandir(self.path):
+			if not entry.is_file() or entry.name.endswith('.part'):
+				continue
+
+			st = entry.stat()
+			total += st.st_size
+			blobs.append((st.st_mtime, st.st_size, entry.path))
+
+		blobs.sort()
+
+		for mtime, size, path in blobs:
+			if total <= self.budget:
+				break
+
+			if path in keep:
+				continue
+
+			try:
+				os.remove(path)
+				total -= size
+			except OSError:
+				pass
+
+
+class BlobWriter:
+	def __init__(self, cache, digest):
+		self.cache  = cache
+		self.digest = digest
+		self.path   = cache.blob_path(digest)
+		import hashlib
+		self.hash   = hashlib.new(digest.partition(':')[0])
+		self.offset = 0
+
+		# continue a download which was interrupted in a previous run
+
+		if os.path.exists(self.path + '.part'):
+			with open(self.path + '.part', 'rb') as f:
+				for chunk in iter(lambda: f.read(1024 * 1024), b''):
+					self.hash.update(chunk)
+					self.offset += len(chunk)
+
+		self.file = open(self.path + '.part', 'ab')
+
+	def write(self, data):
+		"""
+		Writes the data into the blob being downloaded.
+
+		:param data: Data to write.
+		"""
+
+		self.hash.update(data)
+		self.file.write(data)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.file.close()
+
+		# only add the blob to the cache if it was downloaded completely and is not corrupted,
+		# and keep interrupted downloads, so they can be resumed later
+
+		if exc_type is not None:
+			return False
+
+		if self.hash.hexdigest() == self.digest.partition(':')[2]:
+			os.replace(self.path + '.part', self.path)
+			return False
+
+		os.remove(self.path + '.part')
+
+		raise ValueError('downloaded data does not match digest %s' % self.digest)
+
+
+# client for the Docker Registry HTTP API, keeping the connections alive between requests
+
+class RegistryClient:
+	"""
+	Fetches manifests and blobs of an image from a registry. Each thread keeps its own
+	persistent connection per host, and the authorization token is shared between them,
+	so it is only requested again once it expired or was rejected.
+	"""
+
+	def __init__(self, image, registry = 'https://registry.hub.docker.com', auth = 'https://auth.docker.io/token?service=registry.docker.io&scope=repository:%s:pull'):
+		"""
+		Initializes the client.
+
+		:param image: Name of the image, including the namespace.
+		:param registry: Base URL of the registry.
+		:param auth: URL of the token service, with a placeholder for the image, or empty to skip authorization.
+		"""
+
+		self.image    = image
+		self.registry = registry.rstrip('/')
+		self.auth     = auth
+		self.token    = ''
+		self.expire   = 0
+		self.total    = 0
+		self.received = 0
+		self.closed   = False
+		self.lock     = threading.Lock()
+		self.tlock    = threading.Lock()
+		self.local    = threading.local()
+		self.conns    = []
+
+	def refresh_token(self, stale = None):
+		"""
+		Requests a new authorization token, unless another thread already did so.
+
+		:param stale: Token which was found to be expired or rejected, if any.
+
+		:return: Current token.
+		"""
+
+		with self.tlock:
+			if self.token and self.token != stale and self.expire > time.time():
+				return self.token
+
+			with self.request(self.auth % self.image, False) as f:
+				data = json.loads(f.read().decode('utf-8'))
+
+			self.token  = data['token']
+			self.expire = time.time() + data.get('expires_in', 60)
+
+			return self.token
+
+	def connection(self, scheme, host):
+		"""
+		Gets the persistent connection of the current thread to the specified host.
+
+		:param scheme: Scheme of the URL, either http or https.
+		:param host: Host and optional port.
+
+		:return: HTTPConnection instance.
+		"""
+
+		conns = getattr(self.local, 'conns', None)
+
+		if conns is None:
+			conns = self.local.conns = {}
+
+		conn = conns.get((scheme, host))
+
+		if conn is None:
+			import http.client
+			conn = http.client.HTTPSConnection(host) if scheme == 'https' else http.client.HTTPConnection(host)
+			conns[(scheme, host)] = conn
+
+			with self.lock:
+				self.conns.append(conn)
+
+		return conn
+
+	def drop_connections(self):
+		"""
+		Closes the connections of the current thread, when a response was not read completely.
+		"""
+
+		for conn in getattr(self.local, 'conns', {}).values():
+			conn.close()
+
+	def request(self, url, auth = True, offset = 0):
+		"""
+		Sends a GET request, following redirects and refreshing the token if it was rejected.
+
+		:param url: URL to request.
+		:param auth: Whether to send the authorization token.
+		:param offset: Offset to request the rest of the file from, or 0 for the whole file.
+
+		:return: HTTPResponse instance with status 200, or 206 for partial content.
+		"""
+
+		import http.client
+		import urllib.error
+		import urllib.parse
+
+		retried = False
+
+		for _ in range(10):
+			parts   = urllib.parse.urlsplit(url)
+			path    = parts.path + ('?' + parts.query if parts.query else '')
+			conn    = self.connection(parts.scheme, parts.netloc)
+			headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+			token   = ''
+
+			if auth and self.auth:
+				token = self.token if self.expire > time.time() else self.refresh_token(self.token)
+				headers['Authorization'] = 'Bearer ' + token
+
+			try:
+				conn.request('GET', path, headers = headers)
+				resp = conn.getresponse()
+
+			except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+
+				# the server closed the idle connection, reconnect once
+
+				conn.close()
+				conn.request('GET', path, headers = headers)
+				resp = conn.getresponse()
+
+			if resp.status in (301, 302, 303, 307, 308):
+				resp.read()
+				url = urllib.parse.urljoin(url, resp.getheader('Location'))
+
+				# blobs are usually redirected to a CDN, which should not receive the token
+
+				auth = auth and urllib.parse.urlsplit(url).netloc == parts.netloc
+				continue
+
+			if resp.status == 401 and token and not retried:
+				resp.read()
+				self.refresh_token(token)
+				retried = True
+				continue
+
+			if resp.status not in (200, 206):
+				resp.read()
+				raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+
+			return resp
+
+		raise urllib.error.HTTPError(url, 310, 'Too many redirects', None, None)
+
+	def get_manifest(self, tag):
+		"""
+		Fetches the manifest of the image.
+
+		:param tag: Tag or digest of the image.
+
+		:return: Parsed manifest.
+		"""
+
+		with self.request('%s/v2/%s/manifests/%s' % (self.registry, self.image, tag)) as f:
+			return json.loads(f.read().decode('utf-8'))
+
+	def fetch_blob(self, digest, dest, offset = 0):
+		"""
+		Downloads a blob, adding its size to the total and received counters. If the
+		connection drops, the download is resumed with a range request.
+
+		:param digest: Digest of the blob.
+		:param dest: Destination stream.
+		:param offset: Number of bytes already downloaded in a previous attempt.
+
+		:return: Size of the blob.
+		"""
+
+		url    = '%s/v2/%s/blobs/%s' % (self.registry, self.image, digest)
+		counts = [offset]
+
+		def opener(offset):
+
+			# when retrying, the previous response was cut off, so its connection can not be reused
+
+			if not counts:
+				self.drop_connections()
+
+			u = self.request(url, True, offset)
+
+			# only count the size of the first response, retries request the remainder of it
+
+			if counts:
+				with self.lock:
+					self.total    += int(u.getheader('Content-Length') or 0) + check_range(u, counts[0])
+					self.received += counts.pop()
+
+			return u
+
+		try:
+			return resumable_copy(digest, opener, TeeFileObject(dest, self), offset, False)
+
+		except:
+			self.drop_connections()
+			raise
+
+	def write(self, data):
+		"""
+		Counts the downloaded data, aborting the download if the client was closed.
+
+		:param data: Data downloaded.
+		"""
+
+		if self.closed:
+			raise InterruptedError('download was cancelled')
+
+		with self.lock:
+			self.received += len(data)
+
+	def close(self):
+		"""
+		Cancels the running downloads and closes all connections.
+		"""
+
+		self.closed = True
+
+		with self.lock:
+			for conn in self.conns:
+				conn.close()
+
+
+# FileIO wrapper with progress bar
+
+class ProgressFileObject(io.FileIO):
+	def __init__(self, path, *args, **kwargs):
+		self._total_size = os.path.getsize(path)
+		io.FileIO.__init__(self, path, *args, **kwargs)
+
+		# the position is sampled by the progress bar, so reads go straight to FileIO.read
+
+		self.progress = ProgressReporter(sample = lambda: (self.tell(), self._total_size)).start()
+
+	def close(self):
+		if not self.closed:
+			self.progress.stop()
+
+		io.FileIO.close(self)
+
+
+# stream wrapper with progress bar, for archives piped into the process
+
+class ProgressStreamObject(io.RawIOBase):
+	def __init__(self, stream, size = 0):
+		io.RawIOBase.__init__(self)
+
+		self._stream     = stream
+		self._total_size = size
+		self._recv       = 0
+
+		self.progress = ProgressReporter(sample = lambda: (self._recv, self._total_size)).start()
+
+	def readable(self):
+		return True
+
+	def readinto(self, b):
+		"""
+		Read bytes into a pre-allocated, writable bytes-like object b.
+		Returns 0 at EOF.
+		"""
+
+		size = self._stream.readinto(b)
+		self._recv += size
+
+		return size
+
+	def close(self):
+		if not self.closed:
+			self.progress.stop()
+
+		io.RawIOBase.close(self)
+
+
+# memory mapped file object with progress bar, for uncompressed tarballs, which hands out the
+# contents of the members as views into the mapping, so they are written to disk without being
+# read into intermediate buffers first
+
+class MappedFileObject(io.RawIOBase):
+	def __init__(self, path):
+		io.RawIOBase.__init__(self)
+
+		self._file = open(path, 'rb')
+
+		try:
+			self._map = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+		except Exception:
+			self._file.close()
+			raise
+
+		self._view = memoryview(self._map)
+		self._pos  = 0
+
+		self.progress = ProgressReporter(sample = lambda: (self._pos, len(self._map))).start()
+
+	@staticmethod
+	def is_plain_tar(path):
+		"""
+		Determines whether the file is an uncompressed tarball, by looking for the magic of
+		the ustar format in the header of the first member.
+
+		:param path: Path to the file.
+
+		:return: Whether the file is an uncompressed tarball.
+		"""
+
+		try:
+			with open(path, 'rb') as f:
+				header = f.read(512)
+
+		except OSError:
+			return False
+
+		return header[257:262] == b'ustar'
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def read(self, size = -1):
+		"""
+		Read at most size bytes, returned as bytes.
+		"""
+
+		end  = len(self._map) if size is None or size < 0 else self._pos + size
+		data = self._map[self._pos:end]
+		self._pos += len(data)
+
+		return data
+
+	def readinto(self, b):
+		"""
+		Read bytes into a pre-allocated, writable bytes-like object b.
+		Returns 0 at EOF.
+		"""
+
+		b    = memoryview(b).cast('B')
+		size = max(0, min(len(b), len(self._map) - self._pos))
+		b[:size] = self._view[self._pos:self._pos + size]
+		self._pos += size
+
+		return size
+
+	def seek(self, offset, whence = io.SEEK_SET):
+		if whence == io.SEEK_CUR:
+			offset += self._pos
+		elif whence == io.SEEK_END:
+			offset += len(self._map)
+
+		if offset < 0:
+			raise ValueError('negative seek position %d' % offset)
+
+		self._pos = offset
+		return self._pos
+
+	def tell(self):
+		return self._pos
+
+	def slice(self, offset, size):
+		"""
+		Returns a part of the file, without copying it.
+
+		:param offset: Offset of the part.
+		:param size: Size of the part.
+
+		:return: Read-only memoryview of the part, valid until the file is closed.
+		"""
+
+		return self._view[offset:offset + size]
+
+	def close(self):
+		if self.closed:
+			return
+
+		self.progress.stop()
+		self._view.release()
+
+		# views handed out which are still referenced keep the mapping alive until they are released
+
+		try:
+			self._map.close()
+		except BufferError:
+			pass
+
+		self._file.close()
+
+		io.RawIOBase.close(self)
+
+
+# normalize the names of archive members
+
+def member_path(name):
+	"""
+	Strips the leading ./ and / prefixes from the name of an archive member, which make it relative
+	to the root of the archive. Only whole prefixes are removed, so the leading dots of hidden files
+	and whiteouts, such as .dockerenv or .wh.foo, are kept.
+
+	:param name: Name of the member.
+
+	:return: Name relative to the root of the archive, or an empty string for the root itself.
+	"""
+
+	while True:
+		if name.startswith('/'):
+			name = name.lstrip('/')
+		elif name.startswith('./'):
+			name = name[2:]
+		else:
+			break
+
+	return '' if name == '.' else name
+
+
+# index the layers concatenated into a tarball, in order to only extract what the final image contains
+
+def index_tar_layers(tar):
+	"""
+	Reads through the members of a tarball made up of concatenated image layers, and determines
+	which members would not be present in the final image: members which are overwritten in a
+	later layer, whiteout entries (.wh.<name>) and the entries they delete from earlier layers,
+	and the contents of opaque directories (.wh..wh..opq) coming from earlier layers.
+
+	Layers are told apart by the end-of-archive zero blocks between them, which the tarball has
+	to be opened with ignore_zeros in order to read past.
+
+	:param tar: TarFile instance, opened with ignore_zeros, before reading any members.
+
+	:return: Set of ordinals of the members to skip, in the order the archive yields them, and the number of layers.
+	"""
+
+	members   = []
+	last      = {}
+	whiteouts = {}
+	opaques   = {}
+	layer     = 0
+
+	expected = 0
+	member   = tar.next()
+
+	while member is not None:
+
+		# zero blocks were skipped since the previous member, a new layer begins
+
+		if member.offset > expected:
+			layer += 1
+
+		name = member_path(member.name).rstrip('/')
+		base = posixpath.basename(name)
+		idx  = len(members)
+
+		if base == '.wh..wh..opq':
+			opaques[posixpath.dirname(name)] = layer
+			members.append(None)
+
+		elif base.startswith('.wh.'):
+			whiteouts[posixpath.join(posixpath.dirname(name), base[len('.wh.'):])] = layer
+			members.append(None)
+
+		else:
+			members.append((name, layer))
+			last[name] = (idx, layer, member.isdir())
+
+		expected = tar.offset
+		member   = tar.next()
+
+	count = layer + 1
+	skip  = set()
+
+	for idx, entry in enumerate(members):
+		if entry is None:
+			skip.add(idx)
+			continue
+
+		name, layer = entry
+
+		# overwritten in a later layer
+
+		if last[name][0] != idx:
+			skip.add(idx)
+			continue
+
+		# deleted by a whiteout, or the entry itself or one of its parents were replaced in a later layer
+
+		path = name
+		hide = whiteouts.get(path, -1) > layer
+
+		while not hide and path:
+			path = posixpath.dirname(path)
+			prev = last.get(path)
+
+			hide = whiteouts.get(path, -1) > layer or opaques.get(path, -1) > layer or (prev is not None and prev[1] > layer and not prev[2])
+
+		if hide:
+			skip.add(idx)
+
+	return skip, count
+
+
+# thread pool for writing extracted entries to disk while the archive is being decoded
+
+class WriterPool:
+	"""
+	Runs the file creation jobs of an extraction on a pool of worker threads, while the
+	caller keeps decoding the archive. Jobs submitted for the same path are run in the
+	order of submission, so an entry overwritten by a later member of the archive, such
+	as the same file in a subsequent layer, always ends up with the last version.
+
+	With a single worker, jobs are run synchronously on the calling thread. The number of
+	finished jobs is counted in done, for displaying the progress of the workers.
+	"""
+
+	def __init__(self, workers, backlog = 0, onerror = None):
+		"""
+		Creates a new writer pool.
+
+		:param workers: Number of worker threads.
+		:param backlog: Maximum number of queued jobs, defaults to four per worker.
+		:param onerror: Function called with the display name and exception of a failed job.
+		"""
+
+		self.workers  = max(1, workers)
+		self.onerror  = onerror
+		self.pending  = {}
+		self.done     = 0
+		self.lock     = threading.Lock()
+		self.slots    = threading.Semaphore(backlog or self.workers * 4)
+		self.executor = None
+
+		if self.workers > 1:
+			import concurrent.futures
+			self.executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+
+	def _run(self, name, func, args):
+		try:
+			func(*args)
+
+		except Exception as err:
+			if self.onerror is not None:
+				self.onerror(name, err)
+
+		finally:
+			with self.lock:
+				self.done += 1
+
+	def _done(self, path, future):
+		with self.lock:
+			if self.pending.get(path) is future:
+				del self.pending[path]
+
+		self.slots.release()
+
+	def barrier(self, path):
+		"""
+		Waits for the queued jobs of the specified path to finish.
+
+		:param path: Path of the entry.
+		"""
+
+		with self.lock:
+			future = self.pending.get(path)
+
+		if future is not None:
+			import concurrent.futures
+			concurrent.futures.wait([future])
+
+	def submit(self, path, name, func, *args):
+		"""
+		Queues a job which writes the specified path. Blocks when the backlog is full.
+
+		:param path: Path of the entry being written.
+		:param name: Name of the entry to display on failure.
+		:param func: Function to call.
+		:param args: Arguments to pass to the function.
+		"""
+
+		if self.executor is None:
+			self._run(name, func, args)
+			return
+
+		self.barrier(path)
+		self.slots.acquire()
+
+		future = self.executor.submit(self._run, name, func, args)
+
+		with self.lock:
+			self.pending[path] = future
+
+		future.add_done_callback(lambda f: self._done(path, f))
+
+	def run(self, path, name, func, *args):
+		"""
+		Runs a job synchronously on the calling thread, after the queued jobs of the same
+		path have finished. Used for entries whose contents have to be streamed.
+
+		:param path: Path of the entry being written.
+		:param name: Name of the entry to display on failure.
+		:param func: Function to call.
+		:param args: Arguments to pass to the function.
+		"""
+
+		self.barrier(path)
+		self._run(name, func, args)
+
+	def close(self):
+		"""
+		Waits for all queued jobs to finish and stops the worker threads.
+		"""
+
+		if self.executor is not None:
+			self.executor.shutdown(wait = True)
+			self.executor = None
+
+
+# rewrite files only from the point where they differ, for updating an installed rootfs in place
+
+def update_file(path, blocks):
+	"""
+	Writes the contents of a file, leaving the parts which are already the same on disk untouched.
+	The existing file is read along with the new contents, and only rewritten from the first
+	difference on, so files which did not change are not written at all.
+
+	:param path: Path to the file, which is created if it does not exist.
+	:param blocks: Iterable of the new contents, as bytes-like objects.
+
+	:return: Whether the file had to be written.
+	"""
+
+	try:
+		f = open(path, 'r+b')
+
+	except FileNotFoundError:
+		with open(path, 'wb') as f:
+			for block in blocks:
+				f.write(block)
+
+		return True
+
+	with f:
+		blocks = iter(blocks)
+		pos    = 0
+
+		for block in blocks:
+			view = memoryview(block).cast('B')
+
+			for offset in range(0, len(view), copy_max_chunk):
+				part = view[offset:offset + copy_max_chunk]
+
+				if f.read(len(part)) != part:
+					f.seek(pos)
+					f.write(view[offset:])
+
+					for block in blocks:
+						f.write(block)
+
+					f.truncate()
+					return True
+
+				pos += len(part)
+
+		# the new contents are a prefix of the existing file
+
+		if f.read(1):
+			f.truncate(pos)
+			return True
+
+	return False
+
+
+# index of the entries of an installed rootfs
+#
+# the manifest is a gzip compressed text file stored as .switch_manifest in the root of the rootfs,
+# so it moves along with it when switching. each line holds the type, permissions, uid, gid, size,
+# mtime and optional sha256 of an entry, then its path, separated by tabs, in the order the writer
+# threads finished them. a path may show up multiple times, in which case the last line is valid.
+
+class Manifest:
+	"""
+	Writes the manifest of a rootfs as its entries are extracted. Entries are added from the
+	writer threads, after their contents went through to disk, so the size and the hash of
+	the contents can be recorded without reading the files again. The final size of each
+	entry is kept in sizes, for the totals of the installation.
+	"""
+
+	name   = '.switch_manifest'
+	header = '#type\tmode\tuid\tgid\tsize\tmtime\tsha256\tpath\n'
+
+	Entry = collections.namedtuple('Entry', ['type', 'mode', 'uid', 'gid', 'size', 'mtime', 'sha256', 'path'])
+
+	def __init__(self, path, hash = False):
+		"""
+		Starts writing the manifest of a rootfs into a temporary file next to the final one.
+
+		:param path: Path to the rootfs.
+		:param hash: Whether to record the sha256 of the contents of the files.
+		"""
+
+		import gzip
+
+		self.path  = os.path.join(path, Manifest.name)
+		self.hash  = hash
+		self.lock  = threading.Lock()
+		self.sizes = {}
+		self.file = io.TextIOWrapper(gzip.open(self.path + '.new', 'wb', compresslevel = 6), encoding = 'utf-8', errors = 'surrogateescape', newline = '\n')
+
+		self.file.write(Manifest.header)
+
+	def add(self, name, attrb, size = 0, digest = ''):
+		"""
+		Adds an entry to the manifest.
+
+		:param name: Path of the entry within the rootfs.
+		:param attrb: lxattrb instance of the entry.
+		:param size: Size of the contents of the entry.
+		:param digest: sha256 of the contents in hex, or an empty string.
+		"""
+
+		line = '%s\t%o\t%d\t%d\t%d\t%d\t%s\t%s\n' % (stat.filemode(attrb.mode)[0], attrb.mode & 0o7777, attrb.uid, attrb.gid, size, attrb.mtime, digest, name.replace('\\', '\\\\').replace('\n', '\\n'))
+
+		with self.lock:
+			self.file.write(line)
+			self.sizes[name] = size
+
+	def track(self, name, attrb, blocks):
+		"""
+		Passes through the contents of a file, and adds the file once all of them were consumed.
+
+		:param name: Path of the file within the rootfs.
+		:param attrb: lxattrb instance of the file.
+		:param blocks: Iterable of the contents, as bytes-like objects.
+
+		:return: Generator of the same blocks.
+		"""
+
+		import hashlib
+
+		size = 0
+		sha  = hashlib.sha256() if self.hash else None
+
+		for block in blocks:
+			size += len(block)
+
+			if sha is not None:
+				sha.update(block)
+
+			yield block
+
+		self.add(name, attrb, size, sha.hexdigest() if sha is not None else '')
+
+	def close(self, commit = True):
+		"""
+		Finishes writing the manifest, and replaces the previous one with it.
+
+		:param commit: Whether to keep the new manifest, or to discard it.
+		"""
+
+		if self.file is None:
+			return
+
+		self.file.close()
+		self.file = None
+
+		if commit:
+			os.replace(self.path + '.new', self.path)
+		else:
+			os.remove(self.path + '.new')
+
+	@staticmethod
+	def read(path):
+		"""
+		Reads the manifest of a rootfs, without touching the rest of the tree.
+
+		:param path: Path to the rootfs.
+
+		:return: Dictionary of Manifest.Entry instances by path, or None if there is no manifest.
+		"""
+
+		import gzip
+
+		entries = {}
+
+		try:
+			with gzip.open(os.path.join(path, Manifest.name), 'rt', encoding = 'utf-8', errors = 'surrogateescape', newline = '\n') as f:
+				for line in f:
+					if line.startswith('#'):
+						continue
+
+					type, mode, uid, gid, size, mtime, digest, name = line[:-1].split('\t', 7)
+
+					if '\\' in name:
+						name = re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), name)
+
+					entries[name] = Manifest.Entry(type, int(mode, 8), int(uid), int(gid), int(size), int(mtime), digest, name)
+
+		except FileNotFoundError:
+			return None
+
+		return entries
+
+
+# standalone function to draw an interactive progressbar
+
+def draw_progress(recv, size, name, suffix = None):
+	"""
+	Draws an interactive progressbar based on the specified information.
+
+	:param recv: Number of bytes received.
+	:param size: Total size of the file.
+	:param name: Name of the file to display.
+	:param suffix: Text to display after the progressbar, which is then drawn narrower to make room for it.
+	"""
+
+	global is_conemu, has_progress, last_progress
+
+	if size > 0 and recv > size:
+		recv = size
+
+	if recv == size:
+		clear_progress()
+		return
+
+	with progress_lock:
+		if time.time() - last_progress < 0.05:
+			return
+
+		has_progress  = True
+		last_progress = time.time()
+
+		if len(name) > 23:
+			name = name[0:20] + '...'
+		else:
+			name = name.ljust(23, ' ')
+
+		if size <= 0:
+
+			# total size is unknown, display the amount received instead
+
+			sys.stdout.write('\r    %s %0.2f MB received%s' % (name, recv / 1024 / 1024, suffix or ''))
+			sys.stdout.flush()
+			return
+
+		width = 50 if suffix is None else 20
+		pct   = round(recv / size * 100, 2)
+		bar   = int(width * recv / size)
+		sys.stdout.write('\r    %s [%s>%s] %0.2f%%%s' % (name, '=' * bar, ' ' * (width - bar), pct, suffix or ''))
+
+		if is_conemu:
+			sys.stdout.write('\033]9;4;1;%0.0f\033\\\033[39m' % pct)
+
+		sys.stdout.flush()
+
+
+def clear_progress():
+	"""
+	Clears the progress bar.
+	"""
+
+	global is_conemu, has_progress
+
+	with progress_lock:
+		if not has_progress:
+			return
+
+		has_progress = False
+
+		sys.stdout.write('\r%s\r' % (' ' * (66 + 23)))
+
+		if is_conemu:
+			sys.stdout.write('\033]9;4;0\033\\\033[39m')
+
+		sys.stdout.flush()
+
+
+# progress bar drawn on a background thread, from counters updated by the loops doing the work
+
+class ProgressReporter:
+	"""
+	Draws the progress bar on a background thread, along with the throughput and the estimated
+	time left, so the loops doing the work only have to update a counter, instead of reading the
+	clock and formatting the progress bar on every iteration.
+	"""
+
+	def __init__(self, size = 0, name = '', recv = 0, sample = None, unit = 'MB/s', scale = 1024 * 1024, interval = 0.1):
+		"""
+		Initializes the reporter. The counters can be updated from any thread.
+
+		:param size: Total amount of work, or 0 if unknown.
+		:param name: Name to display.
+		:param recv: Amount of work already done.
+		:param sample: Function returning the amount of work done and the total, which is called before
+		               each redraw instead of reading the counters, or None.
+		:param unit: Unit of the throughput to display.
+		:param scale: Amount of work making up one unit.
+		:param interval: Time between redraws in seconds.
+		"""
+
+		self.recv     = recv
+		self.size     = size
+		self.name     = name
+		self.sample   = sample
+		self.unit     = unit
+		self.scale    = scale
+		self.interval = interval
+		self.samples  = []
+		self.thread   = None
+		self.stopped  = threading.Event()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *args):
+		self.stop()
+
+	def start(self):
+		"""
+		Starts drawing the progress bar.
+
+		:return: This instance.
+		"""
+
+		hide_cursor()
+
+		self.thread = threading.Thread(target = self.run, daemon = True)
+		self.thread.start()
+
+		return self
+
+	def stop(self):
+		"""
+		Stops drawing the progress bar and clears it. Does nothing if it was not started or was already stopped.
+		"""
+
+		if self.thread is None:
+			return
+
+		self.stopped.set()
+		self.thread.join()
+		self.thread = None
+
+		clear_progress()
+		show_cursor()
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			self.draw()
+
+	def draw(self):
+		"""
+		Samples the counters and redraws the progress bar.
+		"""
+
+		if self.sample is not None:
+			recv, size = self.sample()
+		else:
+			recv, size = self.recv, self.size
+
+		# the throughput is measured over the last few seconds, so it follows changes in speed
+
+		now = time.monotonic()
+		self.samples.append((now, recv))
+
+		while now - self.samples[0][0] > 3:
+			self.samples.pop(0)
+
+		then, before = self.samples[0]
+
+		if now - then < 0.5:
+			draw_progress(recv, size, self.name, '')
+			return
+
+		rate   = (recv - before) / (now - then)
+		suffix = (' %0.2f %s' if self.scale > 1 else ' %0.0f %s') % (rate / self.scale, self.unit)
+
+		if size <= 0:
+			suffix = ' at' + suffix
+
+		elif rate > 0:
+			left    = int((size - recv) / rate)
+			suffix += ', %s left' % ('%d:%02d:%02d' % (left // 3600, left // 60 % 60, left % 60) if left >= 3600 else '%d:%02d' % (left // 60, left % 60))
+
+		draw_progress(recv, size, self.name, suffix)
+
+
+# functions to interact with the default user of WSL
+
+def run_wsl(command):
+	"""
+	Runs a command in the default shell of WSL, as the default user.
+
+	:param command: Command line to run.
+
+	:return: Output of the command.
+	"""
+
+	import subprocess
+	return subprocess.check_output(['cmd', '/c', 'debian.exe run ' + command], universal_newlines = True)
+
+
+# each command run in WSL boots the distribution, which takes seconds, so the default user is
+# found out with a single `id` call, and its home directory is read from /etc/passwd of the rootfs
+# instead. the result is cached in the registry by the label of the rootfs, along with the mtime
+# and size of /etc/passwd, so it is looked up again when users are added or changed
+
+def get_lxss_user(rootfs, registry = None, runner = run_wsl):
+	"""
+	Gets the default user inside WSL.
+
+	:param rootfs: Path to the active rootfs.
+	:param registry: Registry instance to cache the user in, or None to open the one next to the rootfs.
+	:param runner: Function running a command in WSL and returning its output, such as run_wsl.
+
+	:return: Tuple of UID, GID, name and home directory of the user.
+	"""
+
+	passwd = os.path.join(rootfs, 'etc', 'passwd')
+
+	if registry is None:
+		registry = Registry(os.path.dirname(rootfs))
+
+	cached = registry.data.get('users', {}).get(get_label(rootfs))
+
+	if cached is not None and cached['passwd'] == passwd_stamp(rootfs):
+		return cached['uid'], cached['gid'], cached['user'], cached['home']
+
+	# the output may be surrounded by warnings of WSL, and the names may contain spaces
+
+	output = runner('id')
+	match  = re.search(r'uid=(\d+)\(([^)]*)\)\s+gid=(\d+)', output)
+
+	if match is None:
+		raise ValueError('Unexpected output from id: %r' % output.strip())
+
+	uid  = int(match.group(1))
+	user = match.group(2)
+	gid  = int(match.group(3))
+	home = '/root' if uid == 0 else '/home/' + user
+
+	try:
+		with open(passwd, newline = '\n') as f:
+			for line in f:
+				parts = line.rstrip('\n').split(':')
+
+				if len(parts) >= 6 and parts[0] == user and parts[2] == str(uid):
+					home = parts[5] or home
+					break
+
+	except OSError:
+		pass
+
+	try:
+		remember_lxss_user(rootfs, uid, gid, user, home, registry)
+	except OSError:
+		pass
+
+	return uid, gid, user, home
+
+
+def passwd_stamp(rootfs):
+	"""
+	Gets the mtime and size of /etc/passwd in a rootfs, which change when users are added or changed.
+
+	:param rootfs: Path to the rootfs.
+
+	:return: List of the mtime and size, or None if the file is not accessible.
+	"""
+
+	try:
+		st = os.stat(os.path.join(rootfs, 'etc', 'passwd'))
+		return [st.st_mtime_ns, st.st_size]
+
+	except OSError:
+		return None
+
+
+def remember_lxss_user(rootfs, uid, gid, user, home, registry = None):
+	"""
+	Caches the default user of a rootfs in the registry, so get_lxss_user() does not have to ask WSL
+	as long as /etc/passwd of the rootfs is left unchanged.
+
+	:param rootfs: Path to the rootfs.
+	:param uid: UID of the user.
+	:param gid: GID of the user.
+	:param user: Name of the user.
+	:param home: Home directory of the user.
+	:param registry: Registry instance to cache the user in, or None to open the one next to the rootfs.
+	"""
+
+	stamp = passwd_stamp(rootfs)
+	label = get_label(rootfs)
+
+	if stamp is None or not label:
+		return
+
+	if registry is None:
+		registry = Registry(os.path.dirname(rootfs))
+
+	registry.data.setdefault('users', {})[label] = {'passwd': stamp, 'uid': uid, 'gid': gid, 'user': user, 'home': home}
+	registry.save()
+
+
+def set_default_user(user):
+	"""
+	Switches the active user inside WSL to the requested one.
+
+	:param user: Name of the new user.
+	"""
+
+	import subprocess
+
 	try:
 		subprocess.check_call(['cmd', '/C', 'debian.exe config --default-user %s' % (user)])
 